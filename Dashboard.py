@@ -13,183 +13,282 @@
 # limitations under the License.
 #!/usr/bin/env python3
 
+import os
 import streamlit as st
 import pandas
-import plotly.express as px
-import plotly.graph_objs as go
-import country_converter as coco
-import matplotlib.pyplot as plt
 from streamlit.logger import get_logger
-from utils import clean_data, reduce_and_cluster
+from segmentation import data_fingerprint, load_or_fit_segmentation
+from queries import SALES_QUERIES, CUSTOMERS_QUERIES, SUPPLIERS_QUERIES
+from cube import refresh_cube
+from feature_store import refresh_features, load_customer_features, segment_customers, project_customers
+from dbpool import ConnectionPool
+from profiling import PROFILES_PATH, read_profiles
+from plotting import cluster_scatter, scatter_mode, choropleth
+from geo import refresh_country_codes
+from instrumentation import StageTimings
+from extract import refresh_extract, open_extract
+from analytics import CHARTS, filter_state, load_sales_facts
 
 LOGGER = get_logger(__name__)
 conn = st.connection('northwind_db', type='sql')
-cc = coco.CountryConverter()
+DB_PATH = conn.engine.url.database
+# the number of queries run at once, shared by every session of the server
+POOL_SIZE = 4
+# how long the query results of a tab are shared between sessions before they are read again
+TAB_TTL = 60
 
-def build_dash_board() -> None:
-    tab1, tab2, tab3 = st.tabs(["Sales", "Customers", "Suppliers"])
-    with tab1:
-      st.header("Sales")
-      st.write("### Monthly Sales Trend")
-      monthly_sales = conn.query('SELECT strftime(\'%m\',OrderDate) AS Month, SUM(Quantity * UnitPrice) AS MonthlySales FROM Orders INNER JOIN [Order Details] ON Orders.OrderID == [Order Details].OrderID GROUP BY Month;')
-      st.line_chart(monthly_sales, x = "Month", y = "MonthlySales")
-
-      st.write("### Sales by Category")
-      category_sales = conn.query('SELECT Categories.CategoryName AS Category, SUM(Quantity * [Order Details].UnitPrice) AS SalesByCategory FROM Orders INNER JOIN [Order Details] ON Orders.OrderID == [Order Details].OrderID INNER JOIN Products ON [Order Details].ProductID == Products.ProductID INNER JOIN Categories ON Products.CategoryID == Categories.CategoryID GROUP BY Categories.CategoryName;')
-      st.bar_chart(category_sales, x = "Category", y = "SalesByCategory")
-
-      st.write("### Sales by Region")
-      region_sales = conn.query('SELECT ShipCountry, SUM(Quantity * UnitPrice) AS SalesByRegion FROM Orders INNER JOIN [Order Details] ON Orders.OrderID == [Order Details].OrderID GROUP BY ShipRegion;')
-      st.dataframe(region_sales)
-      
-      country_codes = cc.pandas_convert(series=region_sales.ShipCountry, to='ISO3')  
-      z = region_sales.SalesByRegion
-
-      layout = dict(geo={'scope': "world"})
-      data = dict(
-          type='choropleth',
-          locations=country_codes,
-          locationmode='ISO-3',
-          colorscale='Viridis',
-          z=z)
-      map = go.Figure(data=[data], layout=layout)
-      map.update_geos(projection_type="orthographic")
-      map.update_layout(height=300, margin={"r":0,"t":0,"l":0,"b":0})
-      st.plotly_chart(map)
-
-      st.write("### Top 10 Sales")
-      top_10_sales = conn.query('WITH SalesRanked AS (SELECT Products.ProductName AS ProductName, SUM(Quantity * [Order Details].UnitPrice) AS Sales FROM Orders INNER JOIN [Order Details] ON Orders.OrderID == [Order Details].OrderID INNER JOIN Products ON [Order Details].ProductID == Products.ProductID GROUP BY [Order Details].ProductID ORDER BY Sales DESC) SELECT * FROM SalesRanked LIMIT 10;')
-      st.bar_chart(top_10_sales, x = "ProductName", y = "Sales")
-
-      st.write("### Sales by Employee")
-      employee_sales = conn.query('SELECT Employees.FirstName || " " || Employees.LastName AS EmployeeName, SUM(Quantity * [Order Details].UnitPrice) AS SalesByEmployee FROM Employees INNER JOIN Orders ON Employees.EmployeeID == Orders.EmployeeID INNER JOIN [Order Details] ON Orders.OrderID == [Order Details].OrderID GROUP BY EmployeeName;')
-      st.bar_chart(employee_sales, x = "EmployeeName", y = "SalesByEmployee")
-
-    with tab2:
-      st.header("Customers")
-      # Customer Segmentation: A pie chart showing segmentation of customers based on their purchase behavior
-      st.write("### Customer Segmentation")
-      customer_data = conn.query('SELECT Orders.OrderID, Orders.OrderDate, Orders.ShippedDate, Customers.Country AS CustomerCountry, Customers.City AS CustomerCity, Customers.Region AS CustomerRegion, Products.ProductID, Products.ProductName, Products.CategoryID, [Order Details].UnitPrice, [Order Details].Quantity, [Order Details].Discount, Categories.CategoryName, Suppliers.Country AS SupplierCountry, Suppliers.Region AS SupplierRegion, ([Order Details].UnitPrice * [Order Details].Quantity) - ([Order Details].UnitPrice * [Order Details].Quantity * [Order Details].Discount) AS TotalPrice FROM Orders INNER JOIN Customers ON Orders.CustomerID = Customers.CustomerID INNER JOIN [Order Details] ON Orders.OrderID = [Order Details].OrderID INNER JOIN Products ON [Order Details].ProductID = Products.ProductID INNER JOIN Categories ON Products.CategoryID = Categories.CategoryID INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID WHERE Orders.OrderDate BETWEEN \'2010-01-01\' AND \'2020-12-31\' ORDER BY Orders.OrderDate;')
-      st.write("Customer Data")
-      st.dataframe(customer_data)
-      st.write("Customer Profiles")
-      pca_params = {
-        'n_components': 5,
-        'whiten': False,
-        'svd_solver': 'randomized',
-        'tol': 8,
-        'n_oversamples': 4,
-        'power_iteration_normalizer': 'none',
-        'random_state': 8
-      }
-
-      kmeans_params = {
-          'n_clusters': 7,
-          'init': "k-means++",
-          'n_init': 10,
-          'tol': 1.0,
-          'size_min': 120,
-          'random_state': 8
-      }
-
-      umap_params = {
-          'n_neighbors': 75,
-          'min_dist': 0.50, 
-          'n_components': 2,
-          'random_state': 8
-      }
-
-      # transform categorical data
-      df = pandas.DataFrame(customer_data).dropna()
-      # drop ID columns
-      df.drop(['OrderID', 'ProductID', 'CategoryID'], axis=1, inplace=True)
-      # columns to be transformed by one-hot encoder
-      cols_to_transform = ['OrderDate', 'ShippedDate', 'CustomerCountry', 'CustomerCity', 'CustomerRegion', 'ProductName', 'CategoryName', 'SupplierCountry', 'SupplierRegion']
-      cols_to_retain = ['TotalPrice', 'UnitPrice', 'Quantity', 'Discount']
-
-      processed_data = clean_data(df, cols_to_transform, cols_to_retain)
-      score, df_plot, cluster_counts = reduce_and_cluster(processed_data, pca_params, kmeans_params, umap_params, use_constrained=True)
-      
-      # plot clustering results
-      fig = px.scatter(df_plot, x = 'UMAP1', y = 'UMAP2', size_max=10, 
-                          color='Cluster')
-      st.plotly_chart(fig)
-
-      for k in cluster_counts:
-         st.write(f"{k}: {cluster_counts[k]} customers")
-
-      # Customer Lifetime Value (CLV): A bar chart showing the CLV of different customer segments
-      #st.write("### Customer Lifetime Value")
-
-      #Top Customers: A list or bar chart of top customers by sales
-      st.write("### Top Customers")
-      top_customers = conn.query('SELECT Customers.CustomerID AS CustomerName, SUM(Quantity * UnitPrice) AS TotalOrder FROM Customers INNER JOIN Orders ON Customers.CustomerID = Orders.CustomerID INNER JOIN [Order Details] ON Orders.OrderID = [Order Details].OrderID GROUP BY CustomerName ORDER BY TotalOrder DESC LIMIT 10')
-      st.bar_chart(top_customers, x = "CustomerName", y = "TotalOrder")
-
-      #Customer Geographic Distribution: A map showing where customers are located, which can be filtered by the date range and category.
-      st.write("### Customer Geographic Distribution")
-      geographic_distribution = conn.query('SELECT Country, COUNT(*) AS NumCustomers FROM Customers GROUP BY Country')
-      st.bar_chart(geographic_distribution, x = "Country", y = "NumCustomers")
-
-      country_codes = cc.pandas_convert(series=geographic_distribution.Country, to='ISO3')  
-      z = geographic_distribution.NumCustomers
-
-      layout = dict(geo={'scope': "world"})
-      data = dict(
-          type='choropleth',
-          locations=country_codes,
-          locationmode='ISO-3',
-          colorscale='Viridis',
-          z=z)
-      map = go.Figure(data=[data], layout=layout)
-      map.update_geos(projection_type="orthographic")
-      map.update_layout(height=300, margin={"r":0,"t":0,"l":0,"b":0})
-      st.plotly_chart(map)
-
-      #Orders by Customer: A bar chart showing the number of orders by customer
-      st.write("### Orders by Customer")
-      orders_by_customer = conn.query('SELECT Customers.CustomerID AS CustomerName, COUNT(*) AS TotalOrder FROM Customers INNER JOIN Orders ON Customers.CustomerID = Orders.CustomerID GROUP BY Customers.CustomerID ORDER BY TotalOrder DESC')
-      st.bar_chart(orders_by_customer, x="CustomerName", y="TotalOrder")
-
-
-    with tab3:
-      st.header("Suppliers")
-
-      #Supplier Geographic Distribution: A map showing where suppliers are located
-      st.write("### Supplier Geographic Distribution")
-      supplier_distribution = conn.query("SELECT Country, COUNT(*) AS NumSuppliers FROM Suppliers GROUP BY Country")
-      st.bar_chart(supplier_distribution, x="Country", y="NumSuppliers")
-      country_codes = cc.pandas_convert(series=supplier_distribution.Country, to='ISO3')  
-      z = supplier_distribution.NumSuppliers
-
-      layout = dict(geo={'scope': "world"})
-      data = dict(
-          type='choropleth',
-          locations=country_codes,
-          locationmode='ISO-3',
-          colorscale='Viridis',
-          z=z)
-      map = go.Figure(data=[data], layout=layout)
-      map.update_geos(projection_type="orthographic")
-      map.update_layout(height=300, margin={"r":0,"t":0,"l":0,"b":0})
-      st.plotly_chart(map)
-
-      #Products by Supplier: A bar chart showing the number of products supplied by each supplier
-      st.write("### Products by Supplier")
-      products_by_supplier = conn.query("SELECT CompanyName, COUNT(*) AS NumProducts FROM Products INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID GROUP BY Suppliers.SupplierID")
-      st.bar_chart(products_by_supplier, x="CompanyName", y="NumProducts")
-
-      #Inventory Levels by Supplier: A bar chart showing current inventory levels of different products by supplier
-      st.write("### Inventory Levels by Supplier")
-      inventory_levels = conn.query("SELECT CompanyName, SUM(UnitsInStock) AS Inventory FROM Products INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID GROUP BY Suppliers.SupplierID")
-      st.bar_chart(inventory_levels, x="CompanyName", y="Inventory")
-
-      #Orders by Supplier: A bar chart showing the number of orders by supplier
-      st.write("### Orders by Supplier")
-      orders_by_suppliers = conn.query("SELECT CompanyName, COUNT(DISTINCT(OrderID)) AS NumOrders FROM [Order Details] INNER JOIN Products ON [Order Details].ProductID = Products.ProductID INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID GROUP BY Suppliers.SupplierID")
-      st.bar_chart(orders_by_suppliers, x="CompanyName", y="NumOrders")
+@st.cache_resource
+def connection_pool():
+    return ConnectionPool(DB_PATH, size=POOL_SIZE)
+
+@st.cache_data(ttl=60)
+def database_fingerprint():
+    return data_fingerprint(DB_PATH)
+
+# keyed by the data fingerprint or the cube watermark, of which only the current one is ever looked up again, so a
+# single entry is kept and the extract, model and arrays of older data are released
+@st.cache_resource(max_entries=1)
+def load_order_line_extract(fingerprint):
+    # appends the new order lines to the extract, without encoding their feature matrix, which only the model search
+    # reads, then maps it once per server process and data change
+    refresh_extract(DB_PATH)
+    return open_extract()
+
+@st.cache_resource(max_entries=1)
+def load_segmentation_model(fingerprint):
+    return load_or_fit_segmentation(fingerprint, lambda: load_order_line_extract(fingerprint).order_lines())
+
+@st.cache_resource(max_entries=1)
+def refresh_sales_cube(fingerprint):
+    # the country codes of new country names are resolved along with the cube, before the tabs join them
+    refresh_country_codes(DB_PATH)
+    return refresh_cube(DB_PATH)
+
+@st.cache_resource(max_entries=1)
+def load_sales_analytics(watermark):
+    # the order lines of the cube as arrays, read once per server process and cube watermark, their chart results
+    # are memoized per filter state and shared by every session
+    return load_sales_facts(DB_PATH)
+
+@st.cache_data
+def country_map(frame, value):
+    # keyed by the aggregated rows, so a map is only rebuilt when its data changes
+    return choropleth(frame["ISO3"], frame[value])
+
+@st.cache_data
+def load_customer_segments(fingerprint):
+    # folds the new orders into the feature store, then clusters and projects its one row per customer
+    refresh_features(DB_PATH)
+    features = load_customer_features(DB_PATH)
+    projection = project_customers(features)
+    features.insert(0, "Segment", segment_customers(features))
+    df_plot = pandas.DataFrame(projection, columns=["PC1", "PC2"], index=features.index)
+    df_plot["Segment"] = [f"Segment {segment}" for segment in features["Segment"]]
+    return features, df_plot
+
+@st.cache_data
+def load_cluster_profiles(mtime):
+    # keyed by the modification time of the profiles, so a new profiling run is picked up
+    return read_profiles(PROFILES_PATH)
+
+def sales_tab(results, timings) -> None:
+    st.header("Sales")
+    st.write("### Monthly Sales Trend")
+    with timings.stage("monthly_sales"):
+        monthly_sales = results["monthly_sales"]
+        st.line_chart(monthly_sales, x = "Month", y = "MonthlySales")
+
+    st.write("### Sales by Category")
+    with timings.stage("category_sales"):
+        category_sales = results["category_sales"]
+        st.bar_chart(category_sales, x = "Category", y = "SalesByCategory")
+
+    st.write("### Sales by Region")
+    with timings.stage("region_sales"):
+        region_sales = results["region_sales"]
+        st.dataframe(region_sales)
+        st.plotly_chart(country_map(region_sales, "SalesByRegion"))
+
+    st.write("### Top 10 Sales")
+    with timings.stage("top_10_sales"):
+        top_10_sales = results["top_10_sales"]
+        st.bar_chart(top_10_sales, x = "ProductName", y = "Sales")
+
+    st.write("### Sales by Employee")
+    with timings.stage("employee_sales"):
+        employee_sales = results["employee_sales"]
+        st.bar_chart(employee_sales, x = "EmployeeName", y = "SalesByEmployee")
+
+def customers_tab(results, timings) -> None:
+    st.header("Customers")
+    # Customer Segmentation: A pie chart showing segmentation of customers based on their purchase behavior
+    # the customers are clustered on the one row per customer of the feature store
+    st.write("### Customer Segmentation")
+    with timings.stage("customer_segments"):
+        customer_segments, df_customers = load_customer_segments(database_fingerprint())
+        st.plotly_chart(cluster_scatter(df_customers, x="PC1", y="PC2", color="Segment"))
+        for segment, n_customers in customer_segments["Segment"].value_counts().sort_index().items():
+            st.write(f"Segment {segment}: {n_customers} customers")
+        segment_summary = customer_segments.groupby("Segment").agg(
+            Customers=("Frequency", "size"),
+            Recency=("Recency", "mean"),
+            Frequency=("Frequency", "mean"),
+            Monetary=("Monetary", "mean"),
+            DiscountRate=("DiscountRate", "mean"),
+            ShipLatency=("ShipLatency", "mean"),
+        )
+        st.dataframe(segment_summary)
+        st.write("Customer Features")
+        st.dataframe(customer_segments)
+
+    # the persisted order line segmentation, which new orders are assigned to and which the cluster profiles describe
+    st.write("### Order Line Segmentation")
+    with timings.stage("customer_data"):
+        customer_data = load_order_line_extract(database_fingerprint()).table
+        st.write("Order Lines")
+        st.dataframe(customer_data)
+
+    st.write("Order Line Clusters")
+    with timings.stage("segmentation"):
+        # the fitted model is persisted and loaded once per server process, it is only refitted when the data changes
+        segmentation = load_segmentation_model(database_fingerprint())
+        df_plot, cluster_counts = segmentation["df_plot"], segmentation["cluster_counts"]
 
+        # plot clustering results, as WebGL or binned tiles once there are too many points for SVG
+        fig = cluster_scatter(df_plot)
+        st.plotly_chart(fig)
+        if scatter_mode(len(df_plot)) != "svg":
+            st.caption(f"{len(df_plot)} order lines, drawn as {'a stratified sample' if scatter_mode(len(df_plot)) == 'webgl' else 'density tiles'}")
 
+        for k in cluster_counts:
+           st.write(f"{k}: {cluster_counts[k]} order lines")
+
+    st.write("### Order Line Cluster Profiles")
+    with timings.stage("cluster_profiles"):
+        profiles = load_cluster_profiles(os.path.getmtime(PROFILES_PATH)) if os.path.exists(PROFILES_PATH) else None
+        if profiles is None:
+            st.write("Run get_customer_cluster_labels.py to profile the clusters.")
+        else:
+            st.dataframe(profiles, hide_index=True, column_config={"Seasonality": st.column_config.BarChartColumn("Seasonality", y_min=0)})
+
+    # Customer Lifetime Value (CLV): A bar chart showing the CLV of different customer segments
+    #st.write("### Customer Lifetime Value")
+
+    #Top Customers: A list or bar chart of top customers by sales
+    st.write("### Top Customers")
+    with timings.stage("top_customers"):
+        top_customers = results["top_customers"]
+        st.bar_chart(top_customers, x = "CustomerName", y = "TotalOrder")
+
+    #Customer Geographic Distribution: A map showing where customers are located, which can be filtered by the date range and category.
+    st.write("### Customer Geographic Distribution")
+    with timings.stage("geographic_distribution"):
+        geographic_distribution = results["geographic_distribution"]
+        st.bar_chart(geographic_distribution, x = "Country", y = "NumCustomers")
+
+        st.plotly_chart(country_map(geographic_distribution, "NumCustomers"))
+
+    #Orders by Customer: A bar chart showing the number of orders by customer
+    st.write("### Orders by Customer")
+    with timings.stage("orders_by_customer"):
+        orders_by_customer = results["orders_by_customer"]
+        st.bar_chart(orders_by_customer, x="CustomerName", y="TotalOrder")
+
+def suppliers_tab(results, timings) -> None:
+    st.header("Suppliers")
+
+    #Supplier Geographic Distribution: A map showing where suppliers are located
+    st.write("### Supplier Geographic Distribution")
+    with timings.stage("supplier_distribution"):
+        supplier_distribution = results["supplier_distribution"]
+        st.bar_chart(supplier_distribution, x="Country", y="NumSuppliers")
+        st.plotly_chart(country_map(supplier_distribution, "NumSuppliers"))
+
+    #Products by Supplier: A bar chart showing the number of products supplied by each supplier
+    st.write("### Products by Supplier")
+    with timings.stage("products_by_supplier"):
+        products_by_supplier = results["products_by_supplier"]
+        st.bar_chart(products_by_supplier, x="CompanyName", y="NumProducts")
+
+    #Inventory Levels by Supplier: A bar chart showing current inventory levels of different products by supplier
+    st.write("### Inventory Levels by Supplier")
+    with timings.stage("inventory_levels"):
+        inventory_levels = results["inventory_levels"]
+        st.bar_chart(inventory_levels, x="CompanyName", y="Inventory")
+
+    #Orders by Supplier: A bar chart showing the number of orders by supplier
+    st.write("### Orders by Supplier")
+    with timings.stage("orders_by_suppliers"):
+        orders_by_suppliers = results["orders_by_suppliers"]
+        st.bar_chart(orders_by_suppliers, x="CompanyName", y="NumOrders")
+
+TABS = {
+    "Sales": (SALES_QUERIES, sales_tab),
+    "Customers": (CUSTOMERS_QUERIES, customers_tab),
+    "Suppliers": (SUPPLIERS_QUERIES, suppliers_tab),
+}
+
+@st.cache_data(ttl=TAB_TTL)
+def load_tab(tab, watermark):
+    """
+    runs the queries of a tab concurrently, the results are shared by every session until they expire
+    the cube watermark scopes the results read from the sales cube
+    returns the results and the latency of every query, measured when the results were read
+    """
+    timings = StageTimings(thread_cpu=True)
+    results = connection_pool().query_many(TABS[tab][0], timings=timings)
+    return results, timings.frame()
+
+def debug_panel(page_timings, query_timings, chart_timings) -> None:
+    # hidden unless the page is opened with ?debug=1
+    with st.sidebar.expander("Debug", expanded=True):
+        st.write("Page")
+        st.dataframe(page_timings.frame(), hide_index=True)
+        st.write(f"Queries, read up to {TAB_TTL}s ago")
+        st.dataframe(query_timings.sort_values("wall_s", ascending=False), hide_index=True)
+        st.write("Charts")
+        st.dataframe(chart_timings.frame(), hide_index=True)
+
+def sidebar_filters(facts):
+    """
+    shows the filters in the sidebar and returns their filter state, or None when nothing is filtered
+    """
+    st.sidebar.subheader("Filters")
+    first, last = facts.date_range()
+    dates = st.sidebar.date_input("Order date", (first, last), min_value=first, max_value=last)
+    # the range only has its start while its end is being picked
+    start = dates[0] if len(dates) > 0 else first
+    end = dates[1] if len(dates) > 1 else last
+    categories = st.sidebar.multiselect("Category", list(facts.labels["CategoryName"]))
+    countries = st.sidebar.multiselect("Ship country", list(facts.labels["ShipCountry"]))
+    st.sidebar.caption("The customer data, segmentation and profiles are not filtered.")
+    if start <= first and end >= last and not categories and not countries:
+        return None
+    # bounds at the ends of the data are left open, so that they share their results with the unbounded state
+    return filter_state(start if start > first else None, end if end < last else None, categories, countries)
+
+def build_dash_board() -> None:
+    # only the selected tab is queried and rendered, unlike st.tabs which renders all of them on every rerun
+    tab = st.radio("Tab", list(TABS), horizontal=True, label_visibility="collapsed")
+    debug = st.query_params.get("debug") == "1"
+    # chart memory is only traced for the debug panel, tracemalloc slows every allocation down, and the page stages
+    # enclose the chart stages, so their memory is not traced
+    page_timings, chart_timings = StageTimings(trace_memory=False), StageTimings(trace_memory=debug)
+    with page_timings.stage("refresh_cube"):
+        watermark = refresh_sales_cube(database_fingerprint())["watermark"]
+    with page_timings.stage("load_analytics"):
+        facts = load_sales_analytics(watermark)
+    filters = sidebar_filters(facts)
+    with page_timings.stage("load_tab"):
+        results, query_timings = load_tab(tab, watermark)
+    if filters is not None:
+        with page_timings.stage("filter"):
+            # under a filter the charts are aggregated from the order lines instead of read from the queries
+            results = dict(results, **{name: facts.query(name, filters) for name in results if name in CHARTS})
+    with page_timings.stage("render_tab"):
+        TABS[tab][1](results, chart_timings)
+    if debug:
+        debug_panel(page_timings, query_timings, chart_timings)
 
 
 if __name__ == "__main__":
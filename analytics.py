@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# An in-process columnar query layer over the order lines of the sales cube, behind the dashboard's filters.
+# The SalesFact table of the cube is read once per cube watermark into numpy arrays, every dimension factorized into
+# integer codes with its labels kept aside. A filter state is a boolean mask over the rows, and every chart a
+# np.bincount of the codes of its dimension under that mask, so moving a filter re-aggregates the arrays in memory
+# instead of running the joins of the dashboard's queries again. Distinct counts, such as the orders of a customer,
+# count the distinct code pairs. The labels are joined with the dimension tables as in the cube's summaries, which
+# drop the order lines of products, customers and employees missing from their tables.
+# Under a filter, the customer and supplier charts count the customers, suppliers and products of the order lines
+# in the selection, and the inventory is that of the products sold in it.
+# The results of every chart are memoized per filter state.
+import sqlite3
+import datetime
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+FACT_QUERY = "SELECT OrderID, ProductID, OrderDate, Month, CustomerID, EmployeeID, ShipCountry, CategoryName, SupplierID, Sales FROM SalesFact ORDER BY OrderID, ProductID"
+# the fact columns factorized into codes, a missing value gets the code -1
+DIMENSIONS = ["OrderID", "ProductID", "Month", "CustomerID", "EmployeeID", "ShipCountry", "CategoryName", "SupplierID"]
+# the attributes of the dimension members, indexed by their key
+DIMENSION_QUERIES = {
+    "products": "SELECT ProductID, ProductName, SupplierID, UnitsInStock FROM Products",
+    "employees": "SELECT EmployeeID, FirstName || ' ' || LastName AS EmployeeName FROM Employees",
+    "customers": "SELECT CustomerID, Country FROM Customers",
+    "suppliers": "SELECT SupplierID, CompanyName, Country FROM Suppliers",
+    "countries": "SELECT Country, ISO3, Region FROM CountryCodes",
+}
+# the dimension table of the fact columns with attributes
+DIMENSION_KEYS = {"ProductID": "products", "EmployeeID": "employees", "CustomerID": "customers", "SupplierID": "suppliers", "ShipCountry": "countries"}
+# distinct pairs are counted with a bincount over all possible pairs up to this many, and by sorting beyond
+DENSE_PAIRS = 2**20
+# the number of chart results kept, a filter state costs one entry per chart of the selected tab
+MEMO_SIZE = 256
+
+def filter_state(start=None, end=None, categories=(), countries=()):
+    """
+    returns a filter state, hashable so that the results of the charts can be memoized per state
+    parameters:
+        start: the first order date selected, or None
+        end: the last order date selected, or None
+        categories: the category names selected, none selects all of them
+        countries: the ship countries selected, none selects all of them
+    """
+    return (start, end, tuple(sorted(categories)), tuple(sorted(countries)))
+
+class SalesFacts:
+    """
+    the order lines of the sales cube as columnar arrays, and the charts of the dashboard computed from them
+    parameters:
+        facts: the order lines, as returned by FACT_QUERY
+        dimensions: the frames of DIMENSION_QUERIES, by name
+        memo_size: the number of chart results memoized
+    """
+    def __init__(self, facts, dimensions, memo_size=MEMO_SIZE):
+        self.n_rows = len(facts)
+        self.sales = facts["Sales"].to_numpy(np.float64)
+        self.days = pd.to_datetime(facts["OrderDate"]).to_numpy("datetime64[D]")
+        self.codes, self.labels = {}, {}
+        for column in DIMENSIONS:
+            codes, labels = pd.factorize(facts[column], sort=True)
+            self.codes[column], self.labels[column] = codes.astype(np.int32), pd.Index(labels)
+        # the attributes of the members of every dimension, aligned with their codes, and whether the member is in
+        # its dimension table at all
+        self.attributes, self.known = {}, {}
+        for column, name in DIMENSION_KEYS.items():
+            table = dimensions[name].set_index(dimensions[name].columns[0])
+            positions = table.index.get_indexer(self.labels[column])
+            self.attributes[column] = table.reindex(self.labels[column]).reset_index(drop=True)
+            self.known[column] = positions >= 0
+        self.countries = dimensions["countries"].set_index("Country")
+        self.memo_size = memo_size
+        self.hits = 0
+        self._memo = OrderedDict()
+        # the mask of the last filter state, shared by the charts of a tab
+        self._mask = (None, None)
+        # the facts are shared by the sessions of the dashboard, which run in threads
+        self._lock = threading.Lock()
+
+    def date_range(self):
+        """
+        returns the first and the last order date
+        """
+        days = self.days[~np.isnat(self.days)]
+        return (days.min().astype(datetime.date), days.max().astype(datetime.date)) if len(days) else (None, None)
+
+    def _allowed(self, column, values):
+        # a lookup table of the selected codes, with a last entry for the code -1 of missing values
+        allowed = np.zeros(len(self.labels[column]) + 1, dtype=bool)
+        indexer = self.labels[column].get_indexer(list(values))
+        allowed[indexer[indexer >= 0]] = True
+        return allowed[self.codes[column]]
+
+    def mask(self, filters):
+        """
+        returns the rows selected by a filter state, see filter_state, as a boolean mask or a slice of all rows
+        """
+        start, end, categories, countries = filters
+        if start is None and end is None and not categories and not countries:
+            # indexing with a slice returns views instead of copies
+            return slice(None)
+        mask = np.ones(self.n_rows, dtype=bool)
+        if start is not None:
+            mask &= self.days >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= self.days <= np.datetime64(end, "D")
+        if categories:
+            mask &= self._allowed("CategoryName", categories)
+        if countries:
+            mask &= self._allowed("ShipCountry", countries)
+        return mask
+
+    def totals(self, column, mask):
+        """
+        returns the sales and the number of selected rows of every member of a dimension, indexed by its codes
+        """
+        codes = self.codes[column][mask]
+        keep = codes >= 0
+        codes, n = codes[keep], len(self.labels[column])
+        return np.bincount(codes, weights=self.sales[mask][keep], minlength=n), np.bincount(codes, minlength=n)
+
+    def count_distinct(self, column, item, mask):
+        """
+        returns the number of distinct items in the selected rows of every member of a dimension, indexed by its codes
+        """
+        groups, items = self.codes[column][mask], self.codes[item][mask]
+        keep = (groups >= 0) & (items >= 0)
+        n_groups, n_items = len(self.labels[column]), len(self.labels[item])
+        pairs = items[keep].astype(np.int64) * n_groups + groups[keep]
+        if n_groups * n_items <= DENSE_PAIRS:
+            distinct = np.flatnonzero(np.bincount(pairs, minlength=n_groups * n_items))
+        else:
+            # the rows are ordered by OrderID, so pairs of orders are nearly sorted, which the stable sort (a timsort)
+            # takes advantage of
+            pairs = np.sort(pairs, kind="stable")
+            distinct = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+        return np.bincount(distinct % n_groups, minlength=n_groups)
+
+    def query(self, chart, filters):
+        """
+        returns the result of a chart of CHARTS under a filter state, with the columns of the dashboard's query of the same name
+        """
+        key = (chart, filters)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return self._memo[key]
+            if self._mask[0] != filters:
+                self._mask = (filters, self.mask(filters))
+            result = CHARTS[chart](self, self._mask[1])
+            self._memo[key] = result
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return result
+
+def _members(facts, column, keep, value_name, values, label=None, attributes=()):
+    # one row per member of a dimension selected by keep, with its label or attributes and its value
+    frame = pd.DataFrame({label: facts.labels[column][keep]} if label else {})
+    for attribute in attributes:
+        frame[attribute] = facts.attributes[column][attribute].to_numpy()[keep]
+    frame[value_name] = values[keep]
+    return frame
+
+def _top(values, keep, n=None):
+    # the codes selected by keep, by decreasing value
+    codes = np.flatnonzero(keep)
+    return codes[np.argsort(-values[codes], kind="stable")][:n]
+
+def _count_by_country(facts, column, mask, value_name):
+    # the number of members of a dimension with selected rows, by their country
+    _, n = facts.totals(column, mask)
+    countries = facts.attributes[column]["Country"][(n > 0) & facts.known[column]].dropna()
+    counts = countries.value_counts().sort_index()
+    return pd.DataFrame({"Country": counts.index.to_numpy(), value_name: counts.to_numpy(),
+                         "ISO3": facts.countries["ISO3"].reindex(counts.index).to_numpy()})
+
+def monthly_sales(facts, mask):
+    sales, n = facts.totals("Month", mask)
+    return _members(facts, "Month", n > 0, "MonthlySales", sales, label="Month")
+
+def category_sales(facts, mask):
+    sales, n = facts.totals("CategoryName", mask)
+    return _members(facts, "CategoryName", n > 0, "SalesByCategory", sales, label="Category")
+
+def region_sales(facts, mask):
+    sales, n = facts.totals("ShipCountry", mask)
+    frame = _members(facts, "ShipCountry", n > 0, "SalesByRegion", sales, label="ShipCountry", attributes=["Region", "ISO3"])
+    return frame[["ShipCountry", "SalesByRegion", "Region", "ISO3"]]
+
+def top_10_sales(facts, mask):
+    sales, n = facts.totals("ProductID", mask)
+    return _members(facts, "ProductID", _top(sales, (n > 0) & facts.known["ProductID"], 10), "Sales", sales, attributes=["ProductName"])
+
+def employee_sales(facts, mask):
+    sales, n = facts.totals("EmployeeID", mask)
+    return _members(facts, "EmployeeID", (n > 0) & facts.known["EmployeeID"], "SalesByEmployee", sales, attributes=["EmployeeName"])
+
+def top_customers(facts, mask):
+    sales, n = facts.totals("CustomerID", mask)
+    return _members(facts, "CustomerID", _top(sales, (n > 0) & facts.known["CustomerID"], 10), "TotalOrder", sales, label="CustomerName")
+
+def geographic_distribution(facts, mask):
+    return _count_by_country(facts, "CustomerID", mask, "NumCustomers")
+
+def orders_by_customer(facts, mask):
+    orders = facts.count_distinct("CustomerID", "OrderID", mask)
+    return _members(facts, "CustomerID", _top(orders, (orders > 0) & facts.known["CustomerID"]), "TotalOrder", orders, label="CustomerName")
+
+def supplier_distribution(facts, mask):
+    return _count_by_country(facts, "SupplierID", mask, "NumSuppliers")
+
+def products_by_supplier(facts, mask):
+    products = facts.count_distinct("SupplierID", "ProductID", mask)
+    return _members(facts, "SupplierID", (products > 0) & facts.known["SupplierID"], "NumProducts", products, attributes=["CompanyName"])
+
+def inventory_levels(facts, mask):
+    _, n = facts.totals("ProductID", mask)
+    products = facts.attributes["ProductID"][(n > 0) & facts.known["ProductID"]]
+    suppliers = facts.labels["SupplierID"].get_indexer(products["SupplierID"])
+    stock = np.bincount(suppliers[suppliers >= 0], weights=products["UnitsInStock"].fillna(0).to_numpy()[suppliers >= 0], minlength=len(facts.labels["SupplierID"]))
+    sold = np.bincount(suppliers[suppliers >= 0], minlength=len(facts.labels["SupplierID"])) > 0
+    return _members(facts, "SupplierID", sold & facts.known["SupplierID"], "Inventory", stock, attributes=["CompanyName"])
+
+def orders_by_suppliers(facts, mask):
+    orders = facts.count_distinct("SupplierID", "OrderID", mask)
+    return _members(facts, "SupplierID", (orders > 0) & facts.known["SupplierID"], "NumOrders", orders, attributes=["CompanyName"])
+
+# the charts computed from the facts, named as the dashboard's queries whose results they replace under a filter
+CHARTS = {
+    "monthly_sales": monthly_sales,
+    "category_sales": category_sales,
+    "region_sales": region_sales,
+    "top_10_sales": top_10_sales,
+    "employee_sales": employee_sales,
+    "top_customers": top_customers,
+    "geographic_distribution": geographic_distribution,
+    "orders_by_customer": orders_by_customer,
+    "supplier_distribution": supplier_distribution,
+    "products_by_supplier": products_by_supplier,
+    "inventory_levels": inventory_levels,
+    "orders_by_suppliers": orders_by_suppliers,
+}
+
+def load_sales_facts(db_path, memo_size=MEMO_SIZE):
+    """
+    reads the order lines of the sales cube and its dimensions into a SalesFacts, the cube must have been refreshed
+    """
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        facts = pd.read_sql(FACT_QUERY, conn)
+        dimensions = {name: pd.read_sql(sql, conn) for name, sql in DIMENSION_QUERIES.items()}
+    return SalesFacts(facts, dimensions, memo_size)
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Time the charts of the dashboard under a filter state, computed from the sales cube's order lines")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database, with a refreshed sales cube")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, default=None, help="the first order date selected, YYYY-MM-DD")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, default=None, help="the last order date selected, YYYY-MM-DD")
+    parser.add_argument("--categories", nargs="*", default=[], help="the category names selected")
+    parser.add_argument("--countries", nargs="*", default=[], help="the ship countries selected")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    facts = load_sales_facts(args.db)
+    print(f"Loaded {facts.n_rows} order lines in {time.perf_counter() - started:.3f}s")
+    filters = filter_state(args.start, args.end, args.categories, args.countries)
+    for chart in CHARTS:
+        started = time.perf_counter()
+        result = facts.query(chart, filters)
+        print(f"  {chart:<25} {len(result):>6} rows  {1000 * (time.perf_counter() - started):.2f}ms")
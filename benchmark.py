@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Performance baseline of the preprocessing, the model search stages and the dashboard queries on
+# synthetic scale-ups of the Northwind database, see synthetic_data.py.
+# Every stage is timed (wall and CPU) and its peak traced memory is recorded with tracemalloc, which sees
+# Python and numpy allocations but not those made inside numba or native libraries. tracemalloc also slows
+# Python-heavy stages down, so compare runs made with the same settings.
+# Results are written to a JSON file, and a run can be compared against a previous one to flag regressions.
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import sklearn
+import umap.umap_ as umap
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.cluster import KMeans, HDBSCAN, OPTICS, AgglomerativeClustering, SpectralClustering
+from cube import refresh_cube
+from extract import refresh_extract, encode_features, open_extract
+from analytics import CHARTS, filter_state, load_sales_facts
+from geo import refresh_country_codes
+from queries import SALES_QUERIES, CUSTOMERS_QUERIES, SUPPLIERS_QUERIES
+from scoring import SCORERS, score_clusters
+from segmentation import COLS_TO_TRANSFORM, COLS_TO_RETAIN, PCA_PARAMS, KMEANS_PARAMS, UMAP_PARAMS, read_order_lines, prepare
+from synthetic_data import scale_database
+from utils import clean_data, reduce_and_cluster
+
+# representative configurations of the search space of framework.objective
+REDUCERS = {
+    "PCA": lambda: PCA(n_components=5, random_state=0),
+    "t-SNE": lambda: TSNE(n_components=2, random_state=0),
+    "UMAP": lambda: umap.UMAP(n_components=5, random_state=0),
+}
+CLUSTERERS = {
+    "KMeans": lambda: KMeans(n_clusters=7, n_init=10, random_state=0),
+    "HDBSCAN": lambda: HDBSCAN(min_cluster_size=50),
+    "OPTICS": lambda: OPTICS(min_samples=50),
+    "Agglomerative": lambda: AgglomerativeClustering(n_clusters=7),
+    "Spectral": lambda: SpectralClustering(n_clusters=7, affinity="nearest_neighbors", random_state=0),
+}
+# a stage slower than its baseline by more than this fraction is a regression
+DEFAULT_TOLERANCE = 0.25
+# slowdowns smaller than this many seconds are timing noise rather than regressions
+MIN_REGRESSION_S = 0.05
+
+def measure(results, stage, group, rows, func, *args, **kwargs):
+    """
+    runs func(*args, **kwargs), appends its timings and peak memory to results and returns its output
+    a failing stage is recorded with its error and returns None
+    parameters:
+        results: the list the measurement is appended to
+        stage: the name of the stage
+        group: the kind of stage, such as reducer or query
+        rows: the number of rows the stage processes, for its throughput, or a function of the output returning it
+    """
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    output, error = None, None
+    try:
+        output = func(*args, **kwargs)
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if callable(rows):
+        rows = 0 if output is None else rows(output)
+    results.append({
+        "stage": stage,
+        "group": group,
+        "rows": rows,
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "rows_per_s": rows / wall if wall > 0 else None,
+        "peak_mb": peak / 2**20,
+        "error": error,
+    })
+    status = error or f"{wall:.3f}s, {peak / 2**20:.1f} MiB"
+    print(f"  {group:>10} {stage:<40} {rows:>9} rows  {status}", flush=True)
+    return output
+
+def read_query(db_path, sql):
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        return pd.read_sql(sql, conn)
+
+_warmed_up = False
+
+def warm_up(X, n_rows=300):
+    """
+    fits every reducer and clusterer once on a few rows, so that numba compilation and lazy imports are not timed
+    """
+    global _warmed_up
+    if _warmed_up:
+        return
+    X_small = X[:n_rows]
+    embeddings = PCA(n_components=5, random_state=0).fit_transform(X_small)
+    for make in REDUCERS.values():
+        make().fit_transform(X_small)
+    for make in CLUSTERERS.values():
+        make().fit_predict(embeddings)
+    _warmed_up = True
+
+def run_benchmarks(db_path, max_fit_rows=5000, seed=0):
+    """
+    benchmarks every stage on a database and returns the measurements
+    the model stages run on a random sample of at most max_fit_rows order lines, since several of them are
+    quadratic in the number of rows
+    parameters:
+        db_path: the path of the database, it is written to when the sales cube is built
+        max_fit_rows: the number of order lines the reducers, clusterers and scores run on
+        seed: the seed of the sample
+    """
+    results = []
+    measure(results, "refresh_cube", "cube", lambda cube: cube["new_lines"], refresh_cube, db_path, rebuild=True)
+    measure(results, "refresh_country_codes", "cube", lambda n: n, refresh_country_codes, db_path)
+    for tab, queries in [("sales", SALES_QUERIES), ("customers", CUSTOMERS_QUERIES), ("suppliers", SUPPLIERS_QUERIES)]:
+        for name, sql in queries.items():
+            measure(results, f"{tab}.{name}", "query", len, read_query, db_path, sql)
+    # the dashboard's charts under a filter, the second half of the order dates and two categories
+    facts = measure(results, "load_sales_facts", "analytics", lambda facts: facts.n_rows, load_sales_facts, db_path)
+    if facts is not None:
+        first, last = facts.date_range()
+        filters = filter_state(first + (last - first) / 2, None, facts.labels["CategoryName"][:2])
+        for name in CHARTS:
+            measure(results, f"filtered.{name}", "analytics", facts.n_rows, facts.query, name, filters)
+
+    order_lines = prepare(read_order_lines(db_path))
+    X = measure(results, "clean_data", "preprocess", len(order_lines), clean_data, order_lines, COLS_TO_TRANSFORM, COLS_TO_RETAIN)
+    # what every entry point pays instead, once per change of the data and once per process
+    with tempfile.TemporaryDirectory() as extract_dir:
+        measure(results, "refresh_extract", "preprocess", lambda extract: extract["appended"], refresh_extract, db_path, extract_dir, rebuild=True)
+        measure(results, "encode_features", "preprocess", lambda encoded: encoded[1][0], encode_features, extract_dir)
+        measure(results, "open_extract", "preprocess", lambda extract: extract.table.num_rows, open_extract, extract_dir)
+    rows = np.random.default_rng(seed).choice(len(order_lines), size=min(max_fit_rows, len(order_lines)), replace=False)
+    X_fit = X[np.sort(rows)].astype(float)
+    n_fit = len(X_fit)
+    warm_up(X_fit)
+
+    for name, make in REDUCERS.items():
+        measure(results, name, "reducer", n_fit, lambda: make().fit_transform(X_fit))
+    embeddings = PCA(n_components=5, random_state=0).fit_transform(X_fit)
+    labels = None
+    for name, make in CLUSTERERS.items():
+        output = measure(results, name, "clusterer", n_fit, lambda: make().fit_predict(embeddings))
+        if name == "KMeans":
+            labels = output
+    for metric in SCORERS:
+        measure(results, metric, "score", n_fit, score_clusters, embeddings, labels, metric=metric, random_state=seed)
+
+    # the dashboard's segmentation, with the size constraint relaxed when the sample is too small for it
+    kmeans_params = dict(KMEANS_PARAMS, size_min=min(KMEANS_PARAMS["size_min"], n_fit // (2 * KMEANS_PARAMS["n_clusters"])))
+    measure(results, "reduce_and_cluster", "end_to_end", n_fit, reduce_and_cluster, X_fit, PCA_PARAMS, kmeans_params, UMAP_PARAMS, use_constrained=True)
+    return results
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    returns the stages whose wall time grew by more than tolerance, and by more than MIN_REGRESSION_S seconds,
+    over the baseline run at the same scale
+    parameters:
+        results: the measurements of a run, as written by the CLI
+        baseline: the measurements of a previous run
+        tolerance: the relative slowdown that is still accepted
+    """
+    reference = {(r["factor"], r["stage"]): r for r in baseline if r["error"] is None}
+    regressions = []
+    for r in results:
+        base = reference.get((r["factor"], r["stage"]))
+        if base is None or r["error"] is not None or base["wall_s"] <= 0:
+            continue
+        ratio = r["wall_s"] / base["wall_s"]
+        if ratio > 1 + tolerance and r["wall_s"] - base["wall_s"] > MIN_REGRESSION_S:
+            regressions.append({"factor": r["factor"], "stage": r["stage"], "wall_s": r["wall_s"], "baseline_wall_s": base["wall_s"], "ratio": ratio})
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing, the model stages and the dashboard queries on scaled-up data")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database the scale-ups are generated from")
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 10, 100], help="the scale factors to benchmark")
+    parser.add_argument("--max-fit-rows", type=int, default=5000, help="the number of order lines the model stages run on")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator and of the samples")
+    parser.add_argument("--data-dir", default="./cache", help="where the scaled databases are written")
+    parser.add_argument("--output", default="./benchmark.json", help="where the results are written")
+    parser.add_argument("--baseline", default=None, help="a previous results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="the relative slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+    for factor in args.factors:
+        db_path = os.path.join(args.data_dir, f"northwind_x{factor}.db")
+        sizes = scale_database(args.db, db_path, factor, seed=args.seed)
+        print(f"x{factor}: {sizes['orders']} orders, {sizes['order_lines']} order lines")
+        results += [dict(r, factor=factor, **sizes) for r in run_benchmarks(db_path, args.max_fit_rows, args.seed)]
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "sklearn": sklearn.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "max_fit_rows": args.max_fit_rows,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} measurements to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION x{r['factor']} {r['stage']}: {r['wall_s']:.3f}s vs {r['baseline_wall_s']:.3f}s ({r['ratio']:.2f}x)")
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+        sys.exit(1 if regressions else 0)
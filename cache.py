@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Caches for artifacts that are expensive to recompute but fully determined by their inputs.
+# Every entry is keyed by a content hash, so a change in the data or in the settings that
+# produced it yields a new key and the stale entry is simply never looked up again.
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+CACHE_DIR = "./cache"
+EMBEDDING_CACHE_DIR = os.path.join(CACHE_DIR, "embeddings")
+
+class EmbeddingCache:
+    """
+    size-bounded LRU cache of reducer embeddings, optionally backed by a directory of memory-mapped .npy files
+    entries are keyed by the reducer type, its full parameter set and the key of the data it was fitted on;
+    only deterministic reducers (those with a fixed random_state) are cached, as any other would not reproduce the embedding
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, directory=None):
+        """
+        parameters:
+            max_bytes: the total size of the embeddings kept in memory
+            directory: where to persist embeddings across processes and runs, or None to only cache in memory
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    @staticmethod
+    def cacheable(reducer):
+        return reducer.get_params().get("random_state") is not None
+
+    @staticmethod
+    def key(reducer, data_key):
+        digest = hashlib.sha256()
+        digest.update(type(reducer).__name__.encode())
+        digest.update(repr(sorted(reducer.get_params().items())).encode())
+        digest.update(data_key.encode())
+        return digest.hexdigest()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key[:32]}.npy")
+
+    def _remember(self, key, embeddings):
+        if embeddings.nbytes > self.max_bytes:
+            return
+        self._entries[key] = embeddings
+        self._nbytes += embeddings.nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.directory and os.path.exists(self._path(key)):
+            embeddings = np.load(self._path(key), mmap_mode="r")
+            self._remember(key, embeddings)
+            return embeddings
+        return None
+
+    def put(self, key, embeddings):
+        embeddings = np.asarray(embeddings)
+        # entries are shared by every later hit, so nobody may modify them in place
+        embeddings.flags.writeable = False
+        self._remember(key, embeddings)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, embeddings)
+            os.replace(tmp_path, self._path(key))
+
+    def fit_transform(self, reducer, data, data_key, fit=None):
+        """
+        returns the embeddings of data under reducer and whether they came from the cache
+        parameters:
+            reducer: an unfitted reducer
+            data: the data to embed
+            data_key: a key identifying the content of data, such as the feature_key of the order line extract
+            fit: how to compute the embeddings on a miss, defaults to reducer.fit_transform
+        """
+        fit = fit or reducer.fit_transform
+        if not self.cacheable(reducer):
+            return fit(data), False
+        key = self.key(reducer, data_key)
+        embeddings = self.get(key)
+        if embeddings is not None:
+            self.hits += 1
+            return embeddings, True
+        self.misses += 1
+        embeddings = fit(data)
+        self.put(key, embeddings)
+        return embeddings, False
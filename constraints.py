@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Compatibility rules between the sampled reducer/clusterer parameters and the data they run on.
+# framework.objective checks a trial against these rules before fitting anything, so configurations
+# that can only raise are pruned with a reason instead of burning a fit and scoring -1.
+import importlib.util
+from sklearn.neighbors import VALID_METRICS, KDTree, BallTree
+
+# metrics that sklearn's pairwise distances, and so its brute force neighbors search, accept
+SKLEARN_METRICS = set(VALID_METRICS["brute"]) - {"precomputed"}
+# metrics whose parameters (the variance vector V, the inverse covariance VI or the power p) must be passed
+# explicitly once a neighbors tree or a query against other points is involved
+PARAMETRIZED_METRICS = {"mahalanobis", "seuclidean"}
+
+def _tree_metrics(algorithm):
+    if algorithm == "kd_tree":
+        return set(KDTree.valid_metrics)
+    if algorithm == "ball_tree":
+        return set(BallTree.valid_metrics)
+    return None
+
+def check_reducer(params, n_samples, n_features):
+    """
+    returns why a reducer configuration cannot run on the data, or None if it can
+    parameters:
+        params: the trial parameters
+        n_samples: the number of rows of the feature matrix
+        n_features: the number of columns of the feature matrix
+    """
+    reducer = params["reducer"]
+    if reducer == "PCA":
+        limit = min(n_samples, n_features)
+        if params["solver"] == "arpack" and params["pca_n"] >= limit:
+            return f"arpack PCA needs n_components < min(n_samples, n_features) = {limit}"
+        if params["pca_n"] > limit:
+            return f"PCA needs n_components <= min(n_samples, n_features) = {limit}"
+    elif reducer == "t-SNE":
+        metric = params["tsne_metric"]
+        if params["tsne_method"] == "barnes_hut" and params["tsne_n"] > 3:
+            return "barnes_hut t-SNE only supports n_components <= 3"
+        if params["perplexity"] >= n_samples:
+            return f"t-SNE perplexity must be below n_samples = {n_samples}"
+        if metric not in SKLEARN_METRICS:
+            return f"t-SNE metric {metric} is not supported by scikit-learn"
+        if metric == "haversine" and n_features != 2:
+            return f"haversine distance needs 2 input features, the data has {n_features}"
+        if params["tsne_method"] == "barnes_hut" and metric in PARAMETRIZED_METRICS:
+            return f"barnes_hut t-SNE builds a neighbors tree, which needs explicit parameters for {metric}"
+    else:
+        metric = params["umap_metric"]
+        if params["umap_n"] >= n_samples - 1:
+            return f"UMAP needs n_components < n_samples - 1 = {n_samples - 1}"
+        if metric == "haversine" and n_features != 2:
+            return f"haversine distance needs 2 input features, the data has {n_features}"
+    return None
+
+def check_clusterer(params, n_samples, n_components):
+    """
+    returns why a clusterer configuration cannot run on the embeddings, or None if it can
+    parameters:
+        params: the trial parameters
+        n_samples: the number of embedded rows
+        n_components: the dimension of the embeddings
+    """
+    clusterer = params["clusterer"]
+    if clusterer == "KMeans":
+        if params["kmeans_n"] > n_samples:
+            return f"KMeans needs n_clusters <= n_samples = {n_samples}"
+    elif clusterer == "HDBSCAN":
+        metric = params["hdbscan_metric"]
+        tree_metrics = _tree_metrics(params["hdbscan_algo"])
+        if params["hdbscan_n"] > n_samples or params["min_samples"] > n_samples:
+            return f"HDBSCAN min_cluster_size and min_samples must not exceed n_samples = {n_samples}"
+        if metric not in SKLEARN_METRICS:
+            return f"HDBSCAN metric {metric} is not supported by scikit-learn"
+        if tree_metrics is not None and metric not in tree_metrics:
+            return f"HDBSCAN {params['hdbscan_algo']} does not support the {metric} metric"
+        # HDBSCAN passes no metric parameters, and every algorithm but brute builds a tree
+        if metric in PARAMETRIZED_METRICS | {"minkowski"} and params["hdbscan_algo"] != "brute":
+            return f"HDBSCAN trees need explicit parameters for {metric}"
+    elif clusterer == "OPTICS":
+        metric = params["optics_metric"]
+        tree_metrics = _tree_metrics(params["optics_algo"])
+        if params["optics_n"] > n_samples:
+            return f"OPTICS min_samples must not exceed n_samples = {n_samples}"
+        if metric not in SKLEARN_METRICS:
+            return f"OPTICS metric {metric} is not supported by scikit-learn"
+        if tree_metrics is not None and metric not in tree_metrics:
+            return f"OPTICS {params['optics_algo']} does not support the {metric} metric"
+        # OPTICS queries neighbors of the fitted points, which needs the metric parameters even when brute forcing
+        if metric in PARAMETRIZED_METRICS:
+            return f"OPTICS needs explicit parameters for {metric}"
+    elif clusterer == "Agglomerative":
+        if params["agglo_n"] > n_samples:
+            return f"Agglomerative clustering needs n_clusters <= n_samples = {n_samples}"
+    else:
+        affinity = params["affinity"]
+        if affinity in ("precomputed", "precomputed_nearest_neighbors") and n_samples != n_components:
+            return f"{affinity} affinity needs a square matrix, the embeddings are {n_samples} x {n_components}"
+        if params["eigen_solver"] == "amg" and importlib.util.find_spec("pyamg") is None:
+            return "the amg eigen solver needs pyamg, which is not installed"
+        if affinity == "nearest_neighbors" and params["spec_n_neighbors"] >= n_samples:
+            return f"Spectral n_neighbors must be below n_samples = {n_samples}"
+        if params["spec_cluster"] > n_samples:
+            return f"Spectral clustering needs n_clusters <= n_samples = {n_samples}"
+    return None
+
+def check_config(params, n_samples, n_features):
+    """
+    returns why a trial configuration cannot run on the data, or None if it can
+    parameters:
+        params: the trial parameters, as in trial.params
+        n_samples: the number of rows of the feature matrix
+        n_features: the number of columns of the feature matrix
+    """
+    reason = check_reducer(params, n_samples, n_features)
+    if reason is None:
+        n_components = params.get({"PCA": "pca_n", "t-SNE": "tsne_n", "UMAP": "umap_n"}[params["reducer"]])
+        reason = check_clusterer(params, n_samples, n_components)
+    return reason
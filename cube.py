@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# A pre-aggregated sales cube materialized in the Northwind database.
+# SalesFact denormalizes every order line with the dimensions the dashboard groups by, and the SalesBy* summary
+# tables hold the dashboard's aggregates. refresh_cube only folds in the orders newer than the OrderID watermark
+# stored in CubeMeta, so the cost of a refresh follows the number of new orders rather than the size of Orders.
+import sqlite3
+
+CUBE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS SalesFact (
+    OrderID INTEGER NOT NULL,
+    ProductID INTEGER NOT NULL,
+    OrderDate TEXT,
+    Month TEXT,
+    CustomerID TEXT,
+    EmployeeID INTEGER,
+    ShipCountry TEXT,
+    ShipRegion TEXT,
+    CategoryName TEXT,
+    SupplierID INTEGER,
+    Quantity INTEGER,
+    UnitPrice REAL,
+    Discount REAL,
+    Sales REAL,
+    PRIMARY KEY (OrderID, ProductID)
+);
+CREATE INDEX IF NOT EXISTS SalesFact_OrderDate ON SalesFact (OrderDate);
+CREATE INDEX IF NOT EXISTS SalesFact_CustomerID ON SalesFact (CustomerID);
+CREATE INDEX IF NOT EXISTS SalesFact_EmployeeID ON SalesFact (EmployeeID);
+CREATE INDEX IF NOT EXISTS SalesFact_SupplierID ON SalesFact (SupplierID);
+CREATE INDEX IF NOT EXISTS SalesFact_CategoryName ON SalesFact (CategoryName);
+CREATE INDEX IF NOT EXISTS SalesFact_ShipCountry ON SalesFact (ShipCountry);
+
+CREATE TABLE IF NOT EXISTS SalesByMonth (Month TEXT PRIMARY KEY, Sales REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS SalesByCategory (CategoryName TEXT PRIMARY KEY, Sales REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS SalesByCountry (ShipCountry TEXT PRIMARY KEY, Sales REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS SalesByProduct (ProductID INTEGER PRIMARY KEY, ProductName TEXT, Sales REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS SalesByProduct_Sales ON SalesByProduct (Sales DESC);
+CREATE TABLE IF NOT EXISTS SalesByEmployee (EmployeeID INTEGER PRIMARY KEY, EmployeeName TEXT, Sales REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS SalesByCustomer (CustomerID TEXT PRIMARY KEY, Sales REAL NOT NULL, NumOrders INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS SalesByCustomer_Sales ON SalesByCustomer (Sales DESC);
+CREATE INDEX IF NOT EXISTS SalesByCustomer_NumOrders ON SalesByCustomer (NumOrders DESC);
+CREATE TABLE IF NOT EXISTS SalesBySupplier (SupplierID INTEGER PRIMARY KEY, CompanyName TEXT, Sales REAL NOT NULL, NumOrders INTEGER NOT NULL);
+
+CREATE TABLE IF NOT EXISTS CubeMeta (Key TEXT PRIMARY KEY, Value);
+"""
+
+CUBE_TABLES = ["SalesFact", "SalesByMonth", "SalesByCategory", "SalesByCountry", "SalesByProduct", "SalesByEmployee", "SalesByCustomer", "SalesBySupplier"]
+
+# sales are gross of discount, as in the original dashboard queries
+INSERT_FACTS = """
+INSERT INTO SalesFact
+SELECT Orders.OrderID, [Order Details].ProductID, Orders.OrderDate, strftime('%m', Orders.OrderDate), Orders.CustomerID, Orders.EmployeeID,
+       Orders.ShipCountry, Orders.ShipRegion, Categories.CategoryName, Products.SupplierID,
+       [Order Details].Quantity, [Order Details].UnitPrice, [Order Details].Discount, [Order Details].Quantity * [Order Details].UnitPrice
+FROM Orders
+INNER JOIN [Order Details] ON Orders.OrderID = [Order Details].OrderID
+LEFT JOIN Products ON [Order Details].ProductID = Products.ProductID
+LEFT JOIN Categories ON Products.CategoryID = Categories.CategoryID
+WHERE Orders.OrderID > :watermark
+"""
+
+# every summary is additive over disjoint sets of orders, so the new facts are folded in with an upsert;
+# distinct order counts add up too because an order is never split across two refreshes
+UPSERT_SUMMARIES = [
+    """
+    INSERT INTO SalesByMonth (Month, Sales)
+    SELECT Month, SUM(Sales) FROM SalesFact WHERE OrderID > :watermark AND Month IS NOT NULL GROUP BY Month
+    ON CONFLICT (Month) DO UPDATE SET Sales = Sales + excluded.Sales
+    """,
+    """
+    INSERT INTO SalesByCategory (CategoryName, Sales)
+    SELECT CategoryName, SUM(Sales) FROM SalesFact WHERE OrderID > :watermark AND CategoryName IS NOT NULL GROUP BY CategoryName
+    ON CONFLICT (CategoryName) DO UPDATE SET Sales = Sales + excluded.Sales
+    """,
+    """
+    INSERT INTO SalesByCountry (ShipCountry, Sales)
+    SELECT ShipCountry, SUM(Sales) FROM SalesFact WHERE OrderID > :watermark AND ShipCountry IS NOT NULL GROUP BY ShipCountry
+    ON CONFLICT (ShipCountry) DO UPDATE SET Sales = Sales + excluded.Sales
+    """,
+    """
+    INSERT INTO SalesByProduct (ProductID, ProductName, Sales)
+    SELECT SalesFact.ProductID, Products.ProductName, SUM(Sales) FROM SalesFact
+    INNER JOIN Products ON SalesFact.ProductID = Products.ProductID
+    WHERE OrderID > :watermark GROUP BY SalesFact.ProductID
+    ON CONFLICT (ProductID) DO UPDATE SET Sales = Sales + excluded.Sales, ProductName = excluded.ProductName
+    """,
+    """
+    INSERT INTO SalesByEmployee (EmployeeID, EmployeeName, Sales)
+    SELECT SalesFact.EmployeeID, Employees.FirstName || ' ' || Employees.LastName, SUM(Sales) FROM SalesFact
+    INNER JOIN Employees ON SalesFact.EmployeeID = Employees.EmployeeID
+    WHERE OrderID > :watermark GROUP BY SalesFact.EmployeeID
+    ON CONFLICT (EmployeeID) DO UPDATE SET Sales = Sales + excluded.Sales, EmployeeName = excluded.EmployeeName
+    """,
+    """
+    INSERT INTO SalesByCustomer (CustomerID, Sales, NumOrders)
+    SELECT SalesFact.CustomerID, SUM(Sales), COUNT(DISTINCT OrderID) FROM SalesFact
+    INNER JOIN Customers ON SalesFact.CustomerID = Customers.CustomerID
+    WHERE OrderID > :watermark GROUP BY SalesFact.CustomerID
+    ON CONFLICT (CustomerID) DO UPDATE SET Sales = Sales + excluded.Sales, NumOrders = NumOrders + excluded.NumOrders
+    """,
+    """
+    INSERT INTO SalesBySupplier (SupplierID, CompanyName, Sales, NumOrders)
+    SELECT SalesFact.SupplierID, Suppliers.CompanyName, SUM(Sales), COUNT(DISTINCT OrderID) FROM SalesFact
+    INNER JOIN Suppliers ON SalesFact.SupplierID = Suppliers.SupplierID
+    WHERE OrderID > :watermark GROUP BY SalesFact.SupplierID
+    ON CONFLICT (SupplierID) DO UPDATE SET Sales = Sales + excluded.Sales, NumOrders = NumOrders + excluded.NumOrders, CompanyName = excluded.CompanyName
+    """,
+]
+
+def cube_watermark(conn):
+    """
+    returns the largest OrderID folded into the cube, or 0 if the cube is empty
+    """
+    row = conn.execute("SELECT Value FROM CubeMeta WHERE Key = 'watermark'").fetchone()
+    return row[0] if row else 0
+
+def refresh_cube(db_path, rebuild=False):
+    """
+    creates the cube if needed and folds the orders newer than its watermark into it
+    order lines added to or removed from orders that were already folded in are detected from the line counts and
+    trigger a rebuild, lines edited in place are not, so a rebuild has to be forced after such edits
+    parameters:
+        db_path: the path of the SQLite database
+        rebuild: whether to empty the cube and recompute it from all orders
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.executescript(CUBE_SCHEMA)
+        # take the write lock up front so that concurrent refreshes run one after the other
+        conn.execute("BEGIN IMMEDIATE")
+        watermark = cube_watermark(conn)
+        n_lines = conn.execute("SELECT COUNT(*) FROM [Order Details] WHERE OrderID <= ?", (watermark,)).fetchone()[0]
+        if rebuild or n_lines != conn.execute("SELECT COUNT(*) FROM SalesFact").fetchone()[0]:
+            for table in CUBE_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            watermark = 0
+        n_new = conn.execute(INSERT_FACTS, {"watermark": watermark}).rowcount
+        for upsert in UPSERT_SUMMARIES:
+            conn.execute(upsert, {"watermark": watermark})
+        new_watermark = conn.execute("SELECT COALESCE(MAX(OrderID), 0) FROM SalesFact").fetchone()[0]
+        conn.execute("INSERT OR REPLACE INTO CubeMeta (Key, Value) VALUES ('watermark', ?)", (new_watermark,))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {"watermark": new_watermark, "new_lines": n_new, "rebuilt": watermark == 0}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create or incrementally refresh the dashboard's sales cube")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the cube from all orders")
+    args = parser.parse_args()
+    result = refresh_cube(args.db, rebuild=args.rebuild)
+    print(f"Folded {result['new_lines']} order lines into the cube{' (rebuilt)' if result['rebuilt'] else ''}, watermark OrderID {result['watermark']}")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# A pool of read-only SQLite connections shared by the dashboard's sessions, with a thread pool that runs
+# independent queries on them concurrently. sqlite3 releases the GIL while a statement runs, so the queries
+# of a page overlap instead of running one after the other, and with the database in WAL mode they neither
+# block nor are blocked by a cube refresh.
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import pandas
+
+def enable_wal(db_path):
+    """
+    switches the database to write-ahead logging, which persists in the database file
+    returns whether the database is in WAL mode, it stays in its current mode if it cannot be written
+    """
+    try:
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0] == "wal"
+    except sqlite3.OperationalError:
+        return False
+
+class ConnectionPool:
+    """
+    a fixed set of read-only connections to an SQLite database, each used by one thread at a time
+    parameters:
+        db_path: the path of the SQLite database
+        size: the number of connections, and so of queries that can run at once
+    """
+    def __init__(self, db_path, size=4):
+        self.db_path = db_path
+        self.size = size
+        self.wal = enable_wal(db_path)
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._connect())
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite-query")
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # blocks until a connection is idle
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def query(self, sql, params=None):
+        """
+        runs a query on an idle connection and returns its result as a DataFrame
+        """
+        with self.connection() as conn:
+            return pandas.read_sql(sql, conn, params=params)
+
+    def query_many(self, queries, timings=None):
+        """
+        runs independent queries concurrently
+        parameters:
+            queries: a dict of name to SQL, the results are returned as a dict of name to DataFrame
+            timings: an instrumentation.StageTimings with thread CPU clocks measuring every query under its name, if any
+        """
+        def run(name, sql):
+            if timings is None:
+                return self.query(sql)
+            with timings.stage(name):
+                return self.query(sql)
+        futures = {name: self._executor.submit(run, name, sql) for name, sql in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for _ in range(self.size):
+            self._idle.get().close()
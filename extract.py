@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# A columnar extract of the order lines, shared by the model search, the cluster profiling and the dashboard.
+# The order-line join of the database is exported once into uncompressed Arrow IPC files, one part per refresh,
+# which are memory-mapped when read, so opening the extract neither parses a CSV nor runs the join again.
+# refresh_extract only appends the order lines of the orders placed after the OrderDate watermark of the manifest,
+# and rebuilds the extract when the database holds a different number of lines up to the watermark.
+# The one-hot encoded feature matrix of the complete lines, as built by clean_data(..., sparse_output=True), is
+# encoded by encode_features, which only the model search calls, and stored next to the parts as the data, indices
+# and indptr arrays of a float32 CSR matrix, one .npy file each named after their content hash and opened with
+# mmap_mode="r". Its encoder depends on the frequency of every category over all rows, so lines appended by
+# refresh_extract drop the matrix and the next encode_features encodes all parts again.
+import os
+import json
+import hashlib
+import sqlite3
+import sklearn
+import numpy as np
+import pandas
+import pyarrow as pa
+from contextlib import contextmanager
+from scipy import sparse
+from segmentation import ORDER_LINES_SELECT, ORDER_LINES_FILTER, COLS_TO_TRANSFORM, COLS_TO_RETAIN, prepare
+from utils import make_encoder, encode
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the lock is taken with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+EXTRACT_DIR = "./cache/extract"
+# bump whenever the schema, the encoding or the layout of the extract change, an extract of another version is rebuilt
+EXTRACT_VERSION = 2
+MANIFEST = "manifest.json"
+# the arrays of the CSR feature matrix, each stored in its own .npy file
+FEATURE_ARRAYS = ("data", "indices", "indptr")
+
+# the Arrow types of the order lines, fixed so that every part has the same schema whatever its nulls
+EXTRACT_SCHEMA = pa.schema([
+    ("OrderID", pa.int64()),
+    ("OrderDate", pa.string()),
+    ("ShippedDate", pa.string()),
+    ("CustomerCountry", pa.string()),
+    ("CustomerCity", pa.string()),
+    ("CustomerRegion", pa.string()),
+    ("ProductID", pa.int64()),
+    ("ProductName", pa.string()),
+    ("CategoryID", pa.int64()),
+    ("UnitPrice", pa.float64()),
+    ("Quantity", pa.int64()),
+    ("Discount", pa.float64()),
+    ("CategoryName", pa.string()),
+    ("SupplierCountry", pa.string()),
+    ("SupplierRegion", pa.string()),
+    ("TotalPrice", pa.float64()),
+])
+
+# the order lines of the orders placed after the watermark, in the order they were placed
+NEW_LINES_QUERY = ORDER_LINES_SELECT + ORDER_LINES_FILTER + " AND Orders.OrderDate > ? ORDER BY Orders.OrderDate, Orders.OrderID"
+LINES_UP_TO_QUERY = (
+    "SELECT COUNT(*) FROM Orders INNER JOIN Customers ON Orders.CustomerID = Customers.CustomerID"
+    " INNER JOIN [Order Details] ON Orders.OrderID = [Order Details].OrderID INNER JOIN Products ON [Order Details].ProductID = Products.ProductID"
+    " INNER JOIN Categories ON Products.CategoryID = Categories.CategoryID INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID"
+    + ORDER_LINES_FILTER + " AND Orders.OrderDate <= ?"
+)
+
+def read_manifest(directory=EXTRACT_DIR):
+    """
+    returns the manifest of the extract in a directory, or None if there is no extract of the current version
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    return manifest if manifest.get("version") == EXTRACT_VERSION else None
+
+def _write_atomic(path, write, mode="wb"):
+    # write to a temporary file first so concurrent readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def _write_part(path, table):
+    def write(f):
+        # uncompressed, so that the record batches can be memory-mapped in place
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    _write_atomic(path, write)
+
+@contextmanager
+def _locked(directory):
+    # refreshes and encodings of the same extract run one after the other, across processes
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+            return
+        while True:
+            try:
+                # gives up after ten attempts a second apart, so a long refresh is waited for in a loop
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _write_manifest(directory, manifest):
+    _write_atomic(os.path.join(directory, MANIFEST), lambda f: json.dump(manifest, f, indent=1), mode="w")
+
+def _read_parts(directory, parts):
+    return pa.concat_tables([pa.ipc.open_file(pa.memory_map(os.path.join(directory, part))).read_all() for part in parts]) if parts else EXTRACT_SCHEMA.empty_table()
+
+def _feature_files(features):
+    return [f"{features['prefix']}-{name}.npy" for name in FEATURE_ARRAYS]
+
+def _encode_features(directory, table):
+    df = prepare(table.to_pandas())
+    enc = make_encoder(df.shape[0], sparse_output=True).fit(df[COLS_TO_TRANSFORM])
+    processed_data = encode(enc, df, COLS_TO_TRANSFORM, COLS_TO_RETAIN)
+    arrays = [getattr(processed_data, name) for name in FEATURE_ARRAYS]
+    digest = hashlib.sha256()
+    digest.update(repr((processed_data.shape, COLS_TO_TRANSFORM, COLS_TO_RETAIN, sklearn.__version__)).encode())
+    for array in arrays:
+        digest.update(repr((array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    feature_key = digest.hexdigest()
+    features = {"prefix": f"features-{feature_key[:32]}", "key": feature_key, "shape": list(processed_data.shape)}
+    for name, array in zip(_feature_files(features), arrays):
+        if not os.path.exists(os.path.join(directory, name)):
+            _write_atomic(os.path.join(directory, name), lambda f: np.save(f, array))
+    return features
+
+def refresh_extract(db_path, directory=EXTRACT_DIR, rebuild=False):
+    """
+    creates the extract if needed and appends the order lines of the orders placed after its watermark, without
+    encoding them, any change drops the feature matrix until encode_features is called again
+    order lines added to or removed from orders up to the watermark are detected from the line counts and trigger a
+    rebuild, as does an extract of another database, lines edited in place are not, so a rebuild has to be forced after such edits
+    returns the watermark, the number of order lines appended, the number of order lines of the extract and whether it was rebuilt
+    parameters:
+        db_path: the path of the SQLite database
+        directory: the directory of the extract
+        rebuild: whether to drop the extract and export all order lines again
+    """
+    os.makedirs(directory, exist_ok=True)
+    # readers only ever see a complete manifest
+    with _locked(directory):
+        previous = read_manifest(directory)
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            rebuilt = (rebuild or previous is None or previous["db"] != os.path.abspath(db_path)
+                       or conn.execute(LINES_UP_TO_QUERY, (previous["watermark"],)).fetchone()[0] != previous["n_rows"])
+            if not rebuilt:
+                manifest = dict(previous, parts=list(previous["parts"]))
+            else:
+                manifest = {"version": EXTRACT_VERSION, "db": os.path.abspath(db_path), "watermark": "", "n_rows": 0, "parts": [],
+                            "next_part": previous["next_part"] if previous else 0}
+            new_lines = pandas.read_sql(NEW_LINES_QUERY, conn, params=(manifest["watermark"],))
+
+        if new_lines.empty and not rebuilt:
+            return {"watermark": manifest["watermark"], "appended": 0, "n_rows": manifest["n_rows"], "rebuilt": False}
+        if not new_lines.empty:
+            part = f"order_lines-{manifest['next_part']:05d}.arrow"
+            _write_part(os.path.join(directory, part), pa.Table.from_pandas(new_lines, schema=EXTRACT_SCHEMA, preserve_index=False))
+            manifest["parts"].append(part)
+            manifest["next_part"] += 1
+            manifest["n_rows"] += len(new_lines)
+            manifest["watermark"] = new_lines["OrderDate"].max()
+        manifest["features"] = None
+        _write_manifest(directory, manifest)
+        # files are never overwritten, a reader holding the previous manifest keeps reading the ones it mapped,
+        # which on POSIX outlive their removal, the files of an extract of another version are removed too
+        for name in os.listdir(directory):
+            if (name.startswith("features-") and name.endswith(".npy")) or (name.startswith("order_lines-") and name.endswith(".arrow") and name not in manifest["parts"]):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except PermissionError:
+                    # Windows does not remove a file another reader still maps, it is removed by a later refresh
+                    pass
+    return {"watermark": manifest["watermark"], "appended": len(new_lines), "n_rows": manifest["n_rows"], "rebuilt": rebuilt}
+
+def encode_features(directory=EXTRACT_DIR):
+    """
+    encodes the feature matrix of the order lines of the extract, unless it already was since the last refresh_extract
+    returns the cache key and the shape of the feature matrix
+    parameters:
+        directory: the directory of the extract, see refresh_extract
+    """
+    with _locked(directory):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise FileNotFoundError(f"no order line extract of version {EXTRACT_VERSION} in {directory}, run refresh_extract first")
+        if manifest["features"] is None:
+            manifest["features"] = _encode_features(directory, _read_parts(directory, manifest["parts"]))
+            _write_manifest(directory, manifest)
+    return manifest["features"]["key"], tuple(manifest["features"]["shape"])
+
+class OrderLineExtract:
+    """
+    a read-only view of the extract, the order lines are Arrow record batches and the feature matrix a float32 CSR
+    matrix over numpy arrays, both memory-mapped from the files of the manifest read when it was opened
+    features and feature_key are None when the matrix was not encoded since the last refresh, see encode_features
+    parameters:
+        directory: the directory of the extract, see refresh_extract
+    """
+    def __init__(self, directory=EXTRACT_DIR):
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise FileNotFoundError(f"no order line extract of version {EXTRACT_VERSION} in {directory}, run refresh_extract first")
+        self.directory = directory
+        self.watermark = manifest["watermark"]
+        self.table = _read_parts(directory, manifest["parts"])
+        self.feature_key, self.features = None, None
+        if manifest["features"] is not None:
+            arrays = [np.load(os.path.join(directory, name), mmap_mode="r") for name in _feature_files(manifest["features"])]
+            self.feature_key = manifest["features"]["key"]
+            self.features = sparse.csr_matrix(tuple(arrays), shape=tuple(manifest["features"]["shape"]), copy=False)
+
+    def order_lines(self):
+        """
+        returns the order lines as a dataframe, the columns of ORDER_LINES_QUERY
+        """
+        return self.table.to_pandas()
+
+    def prepared(self):
+        """
+        returns the complete order lines without their ID columns, whose rows are those of the feature matrix
+        """
+        return prepare(self.order_lines()).reset_index(drop=True)
+
+    def dense_features(self):
+        """
+        returns the feature matrix as the dense float64 matrix of clean_data, the CSR matrix holds the retained
+        columns in float32, so they are read again at full precision from the order lines
+        """
+        X = self.features.astype(np.float64).toarray()
+        # encode puts the retained columns first
+        X[:, :len(COLS_TO_RETAIN)] = self.prepared()[COLS_TO_RETAIN].to_numpy(dtype=np.float64)
+        return X
+
+def open_extract(directory=EXTRACT_DIR):
+    return OrderLineExtract(directory)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export the order lines of the database and their feature matrix to the columnar extract")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--directory", default=EXTRACT_DIR, help="directory of the extract")
+    parser.add_argument("--rebuild", action="store_true", help="export all order lines again instead of the new ones")
+    parser.add_argument("--no-features", action="store_true", help="only refresh the order lines, leaving the feature matrix to the next model search")
+    args = parser.parse_args()
+    refreshed = refresh_extract(args.db, args.directory, rebuild=args.rebuild)
+    print(f"{'Rebuilt' if refreshed['rebuilt'] else 'Appended'} {refreshed['appended']} order lines up to {refreshed['watermark']}, "
+          f"{refreshed['n_rows']} order lines in {args.directory}")
+    if not args.no_features:
+        _, shape = encode_features(args.directory)
+        print(f"Encoded the feature matrix {shape}")
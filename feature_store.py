@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# A customer-level feature store materialized in the Northwind database.
+# CustomerFeatures holds additive per-customer aggregates of the orders (counts, sums, first and last order dates)
+# and CustomerCategorySpend the net spend of every customer per category. As with the sales cube, refresh_features
+# only folds in the orders newer than the OrderID watermark stored in FeatureStoreMeta. Orders that were not shipped
+# yet when they were folded in are kept in PendingShipments, and their shipping latency is folded in once they ship.
+# The fixed-width feature matrix (RFM, category spend shares, discount behavior and shipping latency) is derived
+# from these aggregates when it is read, so it has one row per customer whatever the number of order lines.
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+
+FEATURE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS CustomerFeatures (
+    CustomerID TEXT PRIMARY KEY,
+    FirstOrderDate TEXT,
+    LastOrderDate TEXT,
+    NumOrders INTEGER NOT NULL DEFAULT 0,
+    NumLines INTEGER NOT NULL DEFAULT 0,
+    Quantity INTEGER NOT NULL DEFAULT 0,
+    GrossSales REAL NOT NULL DEFAULT 0,
+    NetSales REAL NOT NULL DEFAULT 0,
+    DiscountedLines INTEGER NOT NULL DEFAULT 0,
+    DiscountSavings REAL NOT NULL DEFAULT 0,
+    NumShipped INTEGER NOT NULL DEFAULT 0,
+    ShipDays REAL NOT NULL DEFAULT 0,
+    LateShipments INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS CustomerCategorySpend (
+    CustomerID TEXT NOT NULL,
+    CategoryName TEXT NOT NULL,
+    NetSales REAL NOT NULL,
+    PRIMARY KEY (CustomerID, CategoryName)
+);
+CREATE TABLE IF NOT EXISTS PendingShipments (OrderID INTEGER PRIMARY KEY, CustomerID TEXT);
+CREATE TABLE IF NOT EXISTS FeatureStoreMeta (Key TEXT PRIMARY KEY, Value);
+"""
+
+FEATURE_TABLES = ["CustomerFeatures", "CustomerCategorySpend", "PendingShipments"]
+
+# only orders with at least one order line and a customer are folded in
+NEW_ORDERS = """
+Orders.OrderID > :watermark AND Orders.CustomerID IS NOT NULL
+AND EXISTS (SELECT 1 FROM [Order Details] WHERE [Order Details].OrderID = Orders.OrderID)
+"""
+
+# every aggregate is additive over disjoint sets of orders, or a min / max, so the new orders are folded in with upserts
+FOLD_ORDERS = [
+    """
+    INSERT INTO CustomerFeatures (CustomerID, FirstOrderDate, LastOrderDate, NumOrders, NumLines, Quantity, GrossSales, NetSales, DiscountedLines, DiscountSavings)
+    SELECT Orders.CustomerID, MIN(Orders.OrderDate), MAX(Orders.OrderDate), COUNT(DISTINCT Orders.OrderID), COUNT(*), SUM(d.Quantity),
+           SUM(d.UnitPrice * d.Quantity), SUM(d.UnitPrice * d.Quantity * (1 - d.Discount)), SUM(d.Discount > 0), SUM(d.UnitPrice * d.Quantity * d.Discount)
+    FROM Orders INNER JOIN [Order Details] AS d ON Orders.OrderID = d.OrderID
+    WHERE Orders.OrderID > :watermark AND Orders.CustomerID IS NOT NULL
+    GROUP BY Orders.CustomerID
+    ON CONFLICT (CustomerID) DO UPDATE SET
+        FirstOrderDate = MIN(COALESCE(FirstOrderDate, excluded.FirstOrderDate), excluded.FirstOrderDate),
+        LastOrderDate = MAX(COALESCE(LastOrderDate, excluded.LastOrderDate), excluded.LastOrderDate),
+        NumOrders = NumOrders + excluded.NumOrders, NumLines = NumLines + excluded.NumLines, Quantity = Quantity + excluded.Quantity,
+        GrossSales = GrossSales + excluded.GrossSales, NetSales = NetSales + excluded.NetSales,
+        DiscountedLines = DiscountedLines + excluded.DiscountedLines, DiscountSavings = DiscountSavings + excluded.DiscountSavings
+    """,
+    """
+    INSERT INTO CustomerCategorySpend (CustomerID, CategoryName, NetSales)
+    SELECT Orders.CustomerID, Categories.CategoryName, SUM(d.UnitPrice * d.Quantity * (1 - d.Discount))
+    FROM Orders
+    INNER JOIN [Order Details] AS d ON Orders.OrderID = d.OrderID
+    INNER JOIN Products ON d.ProductID = Products.ProductID
+    INNER JOIN Categories ON Products.CategoryID = Categories.CategoryID
+    WHERE Orders.OrderID > :watermark AND Orders.CustomerID IS NOT NULL
+    GROUP BY Orders.CustomerID, Categories.CategoryName
+    ON CONFLICT (CustomerID, CategoryName) DO UPDATE SET NetSales = NetSales + excluded.NetSales
+    """,
+    f"""
+    INSERT INTO PendingShipments (OrderID, CustomerID)
+    SELECT Orders.OrderID, Orders.CustomerID FROM Orders WHERE Orders.ShippedDate IS NULL AND {NEW_ORDERS}
+    """,
+]
+
+# the shipping latency of a set of shipped orders, in days, folded into the customers they belong to
+FOLD_SHIPMENTS = """
+INSERT INTO CustomerFeatures (CustomerID, NumShipped, ShipDays, LateShipments)
+SELECT Orders.CustomerID, COUNT(*), SUM(julianday(Orders.ShippedDate) - julianday(Orders.OrderDate)), SUM(Orders.ShippedDate > Orders.RequiredDate)
+FROM Orders WHERE Orders.ShippedDate IS NOT NULL AND {where}
+GROUP BY Orders.CustomerID
+ON CONFLICT (CustomerID) DO UPDATE SET
+    NumShipped = NumShipped + excluded.NumShipped, ShipDays = ShipDays + excluded.ShipDays, LateShipments = LateShipments + excluded.LateShipments
+"""
+SHIPPED_PENDING = "Orders.OrderID IN (SELECT OrderID FROM PendingShipments)"
+
+# the per-customer features derived from the aggregates, recency is counted in days before the last order of any customer
+FEATURES_QUERY = """
+SELECT CustomerID,
+       julianday((SELECT MAX(LastOrderDate) FROM CustomerFeatures)) - julianday(LastOrderDate) AS Recency,
+       NumOrders AS Frequency,
+       NetSales AS Monetary,
+       NetSales / NumOrders AS AvgOrderValue,
+       CAST(NumLines AS REAL) / NumOrders AS LinesPerOrder,
+       CAST(Quantity AS REAL) / NumLines AS QuantityPerLine,
+       julianday(LastOrderDate) - julianday(FirstOrderDate) AS Tenure,
+       CAST(DiscountedLines AS REAL) / NumLines AS DiscountedShare,
+       DiscountSavings / NULLIF(GrossSales, 0) AS DiscountRate,
+       ShipDays / NULLIF(NumShipped, 0) AS ShipLatency,
+       CAST(LateShipments AS REAL) / NULLIF(NumShipped, 0) AS LateShare
+FROM CustomerFeatures
+WHERE NumOrders > 0
+ORDER BY CustomerID
+"""
+# heavy-tailed features that are log-scaled before standardization
+LOG_FEATURES = ["Frequency", "Monetary", "AvgOrderValue"]
+# the number of customer segments shown on the dashboard
+N_CUSTOMER_SEGMENTS = 4
+
+def feature_watermark(conn):
+    """
+    returns the largest OrderID folded into the feature store, or 0 if it is empty
+    """
+    row = conn.execute("SELECT Value FROM FeatureStoreMeta WHERE Key = 'watermark'").fetchone()
+    return row[0] if row else 0
+
+def refresh_features(db_path, rebuild=False):
+    """
+    creates the feature store if needed, folds the orders newer than its watermark into it and folds in the
+    shipping latency of the pending orders that have shipped since
+    order lines added to or removed from orders that were already folded in are detected from the line counts and
+    trigger a rebuild, lines or ship dates edited in place are not, so a rebuild has to be forced after such edits
+    parameters:
+        db_path: the path of the SQLite database
+        rebuild: whether to empty the feature store and recompute it from all orders
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.executescript(FEATURE_SCHEMA)
+        # take the write lock up front so that concurrent refreshes run one after the other
+        conn.execute("BEGIN IMMEDIATE")
+        watermark = feature_watermark(conn)
+        n_lines = conn.execute("SELECT COUNT(*) FROM [Order Details] INNER JOIN Orders ON [Order Details].OrderID = Orders.OrderID WHERE Orders.OrderID <= ? AND Orders.CustomerID IS NOT NULL", (watermark,)).fetchone()[0]
+        if rebuild or n_lines != conn.execute("SELECT COALESCE(SUM(NumLines), 0) FROM CustomerFeatures").fetchone()[0]:
+            for table in FEATURE_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            watermark = 0
+        conn.execute(FOLD_SHIPMENTS.format(where=SHIPPED_PENDING))
+        n_shipped = conn.execute("DELETE FROM PendingShipments WHERE OrderID IN (SELECT OrderID FROM Orders WHERE ShippedDate IS NOT NULL)").rowcount
+        affected = {row[0] for row in conn.execute(f"SELECT DISTINCT Orders.CustomerID FROM Orders WHERE {NEW_ORDERS}", {"watermark": watermark})}
+        for fold in FOLD_ORDERS:
+            conn.execute(fold, {"watermark": watermark})
+        conn.execute(FOLD_SHIPMENTS.format(where=NEW_ORDERS), {"watermark": watermark})
+        new_watermark = max(watermark, conn.execute(f"SELECT COALESCE(MAX(Orders.OrderID), 0) FROM Orders WHERE {NEW_ORDERS}", {"watermark": watermark}).fetchone()[0])
+        conn.execute("INSERT OR REPLACE INTO FeatureStoreMeta (Key, Value) VALUES ('watermark', ?)", (new_watermark,))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {"watermark": new_watermark, "customers": len(affected), "shipped": n_shipped, "rebuilt": watermark == 0}
+
+def load_customer_features(db_path):
+    """
+    reads the per-customer features of the feature store, one row per customer indexed by CustomerID
+    the spend share of every category is appended as a "Share <category>" column, in the order of the category names,
+    and customers without a shipped order get the mean latency and late share of the others
+    """
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        features = pd.read_sql(FEATURES_QUERY, conn, index_col="CustomerID")
+        spend = pd.read_sql("SELECT CustomerID, CategoryName, NetSales FROM CustomerCategorySpend", conn)
+        categories = pd.read_sql("SELECT CategoryName FROM Categories ORDER BY CategoryName", conn)["CategoryName"]
+    shares = spend.pivot_table(index="CustomerID", columns="CategoryName", values="NetSales", aggfunc="sum", fill_value=0.0)
+    shares = shares.reindex(index=features.index, columns=categories, fill_value=0.0)
+    shares = shares.div(features["Monetary"].where(features["Monetary"] > 0), axis=0).fillna(0.0)
+    features[[f"Share {category}" for category in categories]] = shares.to_numpy()
+    features["DiscountRate"] = features["DiscountRate"].fillna(0.0)
+    return features.fillna(features.mean())
+
+def feature_matrix(features):
+    """
+    returns the standardized float64 matrix of the features, with LOG_FEATURES log-scaled first
+    """
+    X = features.astype(np.float64).copy()
+    X[LOG_FEATURES] = np.log1p(X[LOG_FEATURES].clip(lower=0))
+    std = X.std(ddof=0).replace(0.0, 1.0)
+    return ((X - X.mean()) / std).to_numpy()
+
+def feature_matrix_key(X):
+    """
+    the cache key of a feature matrix, which changes whenever any of its values does
+    """
+    return "customers:" + hashlib.sha256(np.ascontiguousarray(X).tobytes()).hexdigest()
+
+def segment_customers(features, n_clusters=N_CUSTOMER_SEGMENTS, random_state=8):
+    """
+    clusters the customers on their standardized features and returns the segment of every customer
+    """
+    X = feature_matrix(features)
+    n_clusters = min(n_clusters, len(X))
+    return KMeans(n_clusters=n_clusters, n_init=10, random_state=random_state).fit_predict(X)
+
+def project_customers(features, random_state=8):
+    """
+    returns the 2d PCA projection of the standardized features of the customers, for the scatter of their segments
+    """
+    X = feature_matrix(features)
+    return PCA(n_components=min(2, *X.shape), random_state=random_state).fit_transform(X)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Create or incrementally refresh the customer feature store")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the feature store from all orders")
+    args = parser.parse_args()
+    result = refresh_features(args.db, rebuild=args.rebuild)
+    print(f"Folded the new orders of {result['customers']} customers and {result['shipped']} new shipments into the feature store"
+          f"{' (rebuilt)' if result['rebuilt'] else ''}, watermark OrderID {result['watermark']}")
+    features = load_customer_features(args.db)
+    print(f"{features.shape[0]} customers x {features.shape[1]} features")
@@ -4,39 +4,146 @@
 #   2. dimensionality reduction 
 #   3. clustering
 # The purpose of this framework is to find informative subgroups of customers based on the Northwind database, a tutorial schema for managing small business customers
+import os
+import time
 import optuna
+import argparse
 import traceback
 import numpy as np
-import pandas
+from functools import partial
 import umap.umap_ as umap
-from sklearn.metrics import silhouette_score
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.cluster import KMeans, HDBSCAN, OPTICS, AgglomerativeClustering, SpectralClustering
-from utils import clean_data
+from scipy import sparse
+from cache import EmbeddingCache, EMBEDDING_CACHE_DIR
+from utils import feature_footprint, make_sparse_reducer
+from parallel import DEFAULT_STORAGE, make_storage, limit_threads, recover_stale_trials, count_finished_trials, launch_workers, run_with_timeout
+from constraints import check_config
+from scoring import SCORERS, score_clusters
+from instrumentation import StageTimings, record_trial
+from warm_start import MEMO_PATH, DEFAULT_TOP, TrialMemo, read_history, seed_study
+from feature_store import refresh_features, load_customer_features, feature_matrix, feature_matrix_key
+from extract import EXTRACT_DIR, refresh_extract, encode_features, open_extract
 
-raw_data = pandas.read_csv("./sales_data.csv")
-COLS_TO_TRANSFORM = ['OrderDate', 'ShippedDate', 'CustomerCountry', 'CustomerCity', 'CustomerRegion', 'ProductName', 'CategoryName', 'SupplierCountry', 'SupplierRegion']
-COLS_TO_RETAIN = ['TotalPrice', 'UnitPrice', 'Quantity', 'Discount']
+REDUCERS = ["PCA", "t-SNE", "UMAP"]
+CLUSTERERS = ["KMeans", "HDBSCAN", "OPTICS", "Agglomerative", "Spectral"]
+# keep the feature matrix as float32 CSR end to end instead of the dense float64 matrix, set with --sparse
+SPARSE = False
+# wall-clock limit in seconds of the fits of one trial, set with --trial-timeout, None disables it
+TRIAL_TIMEOUT = None
+# cluster quality score maximized by the study, one of scoring.SCORERS, set with --metric
+SCORER = "silhouette"
+# rows sampled by the sampled_silhouette scorer
+SCORE_SAMPLE_SIZE = 2000
+# growing fractions of the data each trial is scored on, reporting to the pruner after each one, set with --fidelities
+FIDELITIES = [1.0]
+# what a row of the clustered matrix is: an order line of the extract, or a customer of the feature store, set with --level
+LEVEL = "order_lines"
+# the cache key and the feature matrix of the order line extract, memory-mapped or densified once per process when LEVEL is order_lines
+ORDER_LINE_DATA = None
+# the cache key and standardized feature matrix of the customers, read once per process when LEVEL is customers
+CUSTOMER_DATA = None
+# whether the per-stage measurements of the trials include the peak memory traced by tracemalloc, set with --no-trace-memory
+TRACE_MEMORY = True
+# the scores of the configurations already evaluated, persisted across workers and runs, set with --memo and --no-memo
+trial_memo = None
+# embeddings of deterministic reducers, reused by trials that only differ in their clusterer
+embedding_cache = EmbeddingCache()
 
-def objective(trial):
-    # 3 dimensionality reduction algorithms (PCA, t-SNE, UMAP) x 5 clustering techniques (KMeans, HDBSCAN, OPTICS, Agglomerative Clustering, Spectral Clustering) experimental design
-    # use OPTUNA to find optimal hyperparameters for each experiment
-    # report maximal hyperparameters and silhouette score, and visualize clusters in 3D
-    data = clean_data(raw_data, COLS_TO_TRANSFORM, COLS_TO_RETAIN)
-    reducer_name = trial.suggest_categorical("reducer", ["PCA", "t-SNE", "UMAP"])
-    clusterer_name = trial.suggest_categorical("clusterer", ["KMeans", "HDBSCAN", "OPTICS", "Agglomerative", "Spectral"])
+def configure(sparse_output=False, trial_timeout=None, scorer="silhouette", score_sample_size=2000, fidelities=(1.0,), cache_bytes=256 * 2**20, cache_dir=None, level="order_lines", db_path="./db/northwind.db", trace_memory=True, memo_path=None, extract_dir=EXTRACT_DIR):
+    """
+    sets the module level settings read by objective, in this process
+    parameters:
+        sparse_output: whether to run the pipeline on the sparse feature matrix
+        trial_timeout: the wall-clock limit in seconds of the fits of one trial, or None
+        scorer: the cluster quality score, one of scoring.SCORERS
+        score_sample_size: the rows sampled by the sampled_silhouette scorer
+        fidelities: the increasing fractions of the data a trial is scored on, ending with 1.0
+        cache_bytes: the memory budget of the embedding cache
+        cache_dir: the directory of the on-disk embedding store shared by the workers, or None
+        level: order_lines to cluster the one-hot encoded order lines, customers to cluster the customer feature store
+        db_path: the database holding the feature store, read when level is customers
+        trace_memory: whether to trace the peak memory of every stage of a trial
+        memo_path: the SQLite file of the score memo, or None to evaluate every configuration
+        extract_dir: the directory of the order line extract, read when level is order_lines
+    """
+    global SPARSE, TRIAL_TIMEOUT, SCORER, SCORE_SAMPLE_SIZE, FIDELITIES, embedding_cache, LEVEL, CUSTOMER_DATA, ORDER_LINE_DATA, TRACE_MEMORY, trial_memo
+    SPARSE = sparse_output
+    TRIAL_TIMEOUT = trial_timeout
+    SCORER = scorer
+    SCORE_SAMPLE_SIZE = score_sample_size
+    FIDELITIES = sorted(set(fidelities) | {1.0})
+    embedding_cache = EmbeddingCache(max_bytes=cache_bytes, directory=cache_dir)
+    LEVEL = level
+    TRACE_MEMORY = trace_memory
+    trial_memo = TrialMemo(memo_path) if memo_path else None
+    if level == "customers":
+        X = feature_matrix(load_customer_features(db_path))
+        CUSTOMER_DATA = (feature_matrix_key(X), X)
+    else:
+        encode_features(extract_dir)
+        extract = open_extract(extract_dir)
+        # the CSR matrix is used in place, a dense run densifies it once into the float64 matrix of clean_data
+        X = extract.features if sparse_output else extract.dense_features()
+        ORDER_LINE_DATA = (f"{extract.feature_key}|{'sparse' if sparse_output else 'dense'}", X)
+
+def load_data():
+    """
+    returns the cache key and the feature matrix the study clusters, as selected by configure
+    """
+    return CUSTOMER_DATA if LEVEL == "customers" else ORDER_LINE_DATA
+
+def make_pruner(name, n_rungs):
+    """
+    builds the pruner that stops weak trials between fidelity rungs
+    parameters:
+        name: none, successive_halving or hyperband
+        n_rungs: the number of fidelity rungs, the resource reported by each trial goes from 1 to n_rungs
+    """
+    if name == "successive_halving":
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=2)
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=n_rungs, reduction_factor=2)
+    return optuna.pruners.NopPruner()
+
+def prune_infeasible(trial, reason):
+    """
+    marks a trial as infeasible and stops it without a score, so it never enters the sampler's model as a -1
+    """
+    trial.set_user_attr("infeasible", reason)
+    raise optuna.TrialPruned(reason)
+
+def remaining_time(deadline):
+    return None if deadline is None else deadline - time.monotonic()
+
+def suggest_pipeline(trial, data):
+    """
+    samples the reducer and the clusterer of a trial, define-by-run
+    returns the unfitted reducer and clusterer, their numbers of components and clusters, and the data they run on,
+    which is densified for t-SNE
+    parameters:
+        trial: the trial, or an optuna.trial.FixedTrial replaying known parameters
+        data: the feature matrix, only its shape and format are used
+    """
+    reducer_name = trial.suggest_categorical("reducer", REDUCERS)
+    clusterer_name = trial.suggest_categorical("clusterer", CLUSTERERS)
     reducer_n, clusterer_n = 0, 0
 
     if reducer_name == 'PCA':
 
         reducer_n = trial.suggest_int("pca_n", 2, 20)
-        whiten = trial.suggest_categorical("whiten", [True, False])
         solver = trial.suggest_categorical("solver", ["full", "arpack", "randomized"])
-        pca_tol = trial.suggest_float("pca_tol", 0.0, 10.0)
+        if sparse.issparse(data) and solver == "randomized":
+            # the sparse randomized solver is a TruncatedSVD, which has neither whitening nor a tolerance
+            whiten, pca_tol = False, 0.0
+        else:
+            whiten = trial.suggest_categorical("whiten", [True, False])
+            pca_tol = trial.suggest_float("pca_tol", 0.0, 10.0)
         n_oversamples = trial.suggest_int("n_oversamples", 1, 20)
         normalizer = trial.suggest_categorical("normalizer", ["auto", "QR", "LU", "none"])
-        reducer = PCA(n_components=reducer_n, whiten=whiten, svd_solver=solver, tol=pca_tol, n_oversamples=n_oversamples, power_iteration_normalizer=normalizer, random_state=99)
+        pca_params = dict(n_components=reducer_n, whiten=whiten, svd_solver=solver, tol=pca_tol, n_oversamples=n_oversamples, power_iteration_normalizer=normalizer, random_state=99)
+        reducer = make_sparse_reducer(pca_params) if sparse.issparse(data) else PCA(**pca_params)
 
     elif reducer_name == 't-SNE':
 
@@ -51,6 +158,9 @@ def objective(trial):
         tsne_metric = trial.suggest_categorical("tsne_metric", ['sokalsneath', 'rogerstanimoto', 'russellrao', 'sokalmichener', 'yule', 'nan_euclidean', 'cosine', 'wminkowski', 'correlation', 'minkowski', 'sqeuclidean', 'chebyshev', 'haversine', 'dice', 'cityblock', 'matching', 'seuclidean', 'hamming', 'l2', 'euclidean', 'braycurtis', 'mahalanobis', 'jaccard', 'manhattan', 'canberra', 'l1'])
         tsne_init = trial.suggest_categorical("tsne_init", ["random", "pca"])
         reducer = TSNE(n_components = reducer_n, method=tsne_method, perplexity=perplexity, early_exaggeration=tightness, learning_rate=tsne_lr, metric=tsne_metric, init=tsne_init, random_state=99)
+        # t-SNE builds dense pairwise affinities regardless of the input format and most of its metrics reject CSR input
+        if sparse.issparse(data):
+            data = data.toarray()
 
     else:
 
@@ -58,7 +168,9 @@ def objective(trial):
         umap_n_neighbors = trial.suggest_int("umap_n_neighbors", 2, 502, step = 5)
         min_dist= trial.suggest_float("min_dist", 0.0, 0.99, step=0.05)
         umap_metric =  trial.suggest_categorical("umap_metric", ["braycurtis", "canberra", "chebyshev", "correlation", "cosine", "dice", "euclidean", "hamming", "haversine", "jaccard", "mahalanobis", "manhattan", "minkowski", "rogerstanimoto", "russellrao", "seuclidean", "sokalmichener", "sokalsneath", "yule"])
-        reducer = umap.UMAP(n_components = reducer_n, n_neighbors=umap_n_neighbors, min_dist=min_dist, metric=umap_metric)
+        # seeded like the other estimators so that the memo and the embedding cache return what a refit would,
+        # which makes UMAP run its optimization in a single thread
+        reducer = umap.UMAP(n_components = reducer_n, n_neighbors=umap_n_neighbors, min_dist=min_dist, metric=umap_metric, random_state=99)
 
     if clusterer_name == 'KMeans':
 
@@ -123,21 +235,168 @@ def objective(trial):
         degree = trial.suggest_categorical("degree", [1.0, 2.0, 3.0, 4.0, 5.0])
         coef0 = trial.suggest_float("coef0", 0.0, 100.0)
         clusterer = SpectralClustering(n_clusters = clusterer_n, n_components=spec_n, eigen_solver=eigen_solver, n_init=spec_n_init, gamma=spec_gamma, affinity=affinity, n_neighbors=spec_n_neighbors, assign_labels=assign_labels, degree=degree, coef0=coef0, random_state=99)
+    return reducer, clusterer, reducer_n, clusterer_n, data
+
+def objective(trial):
+    # 3 dimensionality reduction algorithms (PCA, t-SNE, UMAP) x 5 clustering techniques (KMeans, HDBSCAN, OPTICS, Agglomerative Clustering, Spectral Clustering) experimental design
+    # use OPTUNA to find optimal hyperparameters for each experiment
+    # report maximal hyperparameters and silhouette score, and visualize clusters in 3D
+    # the wall time, CPU time and peak memory of every stage are stored as user attributes of the trial, with
+    # --trial-timeout the fits run in a child process, so only their wall time is measured here
+    timings = StageTimings(trace_memory=TRACE_MEMORY)
+    trial.set_user_attr("metric", SCORER)
+    trial.set_user_attr("level", LEVEL)
+    # encoded once per change of the data by encode_features and loaded once per process by configure
+    data_key, data = load_data()
+    reducer, clusterer, reducer_n, clusterer_n, data = suggest_pipeline(trial, data)
+
+    # every stochastic estimator, UMAP included, is seeded with random_state=99 and the score sample too, so a configuration
+    # scored before on the same data and metric gets the same score again
+    memo_context = f"{data_key}|{SCORER}|{SCORE_SAMPLE_SIZE}"
+    memoized = None if trial_memo is None else trial_memo.get(trial.params, memo_context)
+    if memoized is not None:
+        trial.set_user_attr("memo_hit", True)
+        record_trial(trial, timings)
+        return memoized
+
+    reason = check_config(trial.params, data.shape[0], data.shape[1])
+    if reason is not None:
+        record_trial(trial, timings)
+        prune_infeasible(trial, reason)
 
+    deadline = None if TRIAL_TIMEOUT is None else time.monotonic() + TRIAL_TIMEOUT
+    # the fidelity subsets are nested prefixes of one fixed permutation, so every trial sees the same rows per rung
+    order = np.random.default_rng(99).permutation(data.shape[0])
+    score_fn = partial(score_clusters, metric=SCORER, sample_size=SCORE_SAMPLE_SIZE, random_state=99)
     try:
-        embeddings = reducer.fit_transform(data)
-        labels = clusterer.fit_predict(embeddings)
-        score = silhouette_score(embeddings, labels)
+        for step, fraction in enumerate(FIDELITIES, start=1):
+            n_rows = min(data.shape[0], max(2, int(data.shape[0] * fraction)))
+            subset = data if n_rows == data.shape[0] else data[np.sort(order[:n_rows])]
+            if check_config(trial.params, subset.shape[0], subset.shape[1]) is not None:
+                # too few rows for this configuration at this rung, the full data was checked above
+                continue
+            subset_key = data_key if n_rows == data.shape[0] else f"{data_key}:{n_rows}"
+            fit = lambda X: run_with_timeout(reducer.fit_transform, X, timeout=remaining_time(deadline))
+            with timings.stage("reduce"):
+                embeddings, cache_hit = embedding_cache.fit_transform(reducer, subset, subset_key, fit=fit)
+            with timings.stage("cluster"):
+                labels = run_with_timeout(clusterer.fit_predict, embeddings, timeout=remaining_time(deadline))
+            with timings.stage("score"):
+                score, interval = run_with_timeout(score_fn, embeddings, labels, timeout=remaining_time(deadline))
+            if len(FIDELITIES) > 1:
+                trial.report(score, step)
+                if trial.should_prune():
+                    raise optuna.TrialPruned(f"pruned after scoring {n_rows} rows")
+
+        trial.set_user_attr("embedding_cache_hit", cache_hit)
+        if interval is not None:
+            trial.set_user_attr("score_interval", interval)
+        if trial_memo is not None:
+            trial_memo.put(trial.params, score, memo_context)
         return score
-    
+
+    except optuna.TrialPruned:
+        raise
+
+    except TimeoutError:
+        prune_infeasible(trial, f"timed out after {TRIAL_TIMEOUT}s")
+
     except Exception as e:
         print(f"Error with combination: {reducer} (n_components={reducer_n}), {clusterer} (n_clusters={clusterer_n})")
         print(traceback.format_exc())
+        if trial_memo is not None:
+            trial_memo.put(trial.params, -1, memo_context)
         return -1  # Return a bad score if an error occurs
 
+    finally:
+        record_trial(trial, timings)
+
+def run_worker(storage, study_name, n_trials, n_threads, pruner, settings):
+    """
+    runs trials of a shared study until it holds n_trials finished trials
+    parameters:
+        storage: the storage url or journal file shared by all workers
+        study_name: the name of the study in the storage
+        n_trials: the total number of finished trials across all workers
+        n_threads: the number of BLAS/OpenMP/numba threads this worker may use
+        pruner: the name of the pruner, see make_pruner
+        settings: the keyword arguments of configure
+    """
+    configure(**settings)
+    limit_threads(n_threads)
+    study = optuna.load_study(study_name=study_name, storage=make_storage(storage), pruner=make_pruner(pruner, len(FIDELITIES)))
+    if count_finished_trials(study) >= n_trials:
+        return
+    budget = optuna.study.MaxTrialsCallback(n_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))
+    study.optimize(objective, callbacks=[budget])
+
 if __name__ == "__main__":
-    study = optuna.create_study(direction="maximize")
-    study.optimize(objective, n_trials=1000)
+    parser = argparse.ArgumentParser(description="Optuna search over dimensionality reduction x clustering pipelines")
+    parser.add_argument("--level", choices=["customers", "order_lines"], default="customers", help="cluster the customers of the feature store or the one-hot encoded order lines")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database the feature store or the order line extract is refreshed from")
+    parser.add_argument("--sparse", action="store_true", help="keep the one-hot feature matrix as float32 CSR through the pipeline")
+    parser.add_argument("--n-trials", type=int, default=1000, help="total number of finished trials in the study, including those of earlier runs")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the study")
+    parser.add_argument("--threads", type=int, default=None, help="BLAS/OpenMP/numba threads per worker, defaults to cpu count / workers")
+    parser.add_argument("--trial-timeout", type=float, default=None, help="kill the fits of a trial after this many seconds and prune it")
+    parser.add_argument("--embedding-cache-mb", type=float, default=256, help="memory budget of the per-worker embedding cache")
+    parser.add_argument("--embedding-cache-dir", nargs="?", const=EMBEDDING_CACHE_DIR, default=None, help="also persist embeddings as memory-mapped .npy files shared by workers and runs")
+    parser.add_argument("--metric", choices=SCORERS, default="silhouette", help="cluster quality score to maximize, davies_bouldin is negated")
+    parser.add_argument("--score-sample-size", type=int, default=2000, help="rows sampled by the sampled_silhouette metric")
+    parser.add_argument("--fidelities", type=lambda v: [float(f) for f in v.split(",")], default=[1.0], help="comma separated fractions of the data to score each trial on, e.g. 0.1,0.3,1.0")
+    parser.add_argument("--pruner", choices=["none", "successive_halving", "hyperband"], default="none", help="pruner stopping weak trials between fidelities")
+    parser.add_argument("--no-trace-memory", action="store_true", help="only time the stages of a trial, without tracing their peak memory with tracemalloc")
+    parser.add_argument("--warm-start", action="append", default=[], help="a trials dataframe of an earlier run (such as session.csv) to seed the study from, can be repeated")
+    parser.add_argument("--warm-start-mode", choices=["enqueue", "import"], default="enqueue", help="evaluate the best earlier configurations again, or import the earlier trials with their scores")
+    parser.add_argument("--warm-start-top", type=int, default=DEFAULT_TOP, help="the number of best distinct configurations taken from each history, 0 for all")
+    parser.add_argument("--memo", default=MEMO_PATH, help="the SQLite file of the score memo shared by the workers and runs")
+    parser.add_argument("--no-memo", action="store_true", help="evaluate every configuration, even one scored before")
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, help="journal file or RDB url (e.g. sqlite:///optuna.db) holding the study")
+    parser.add_argument("--study-name", default=None, help="name of the study, an existing study is resumed, northwind-customers or northwind by level")
+    parser.add_argument("--output", default="./session.csv", help="where to write the trials dataframe")
+    args = parser.parse_args()
+    args.study_name = args.study_name or ("northwind-customers" if args.level == "customers" else "northwind")
+    # fold the new orders into the feature store or the extract once, before the workers read it
+    if args.level == "customers":
+        refresh_features(args.db)
+    else:
+        refresh_extract(args.db)
+    n_threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    settings = dict(sparse_output=args.sparse, trial_timeout=args.trial_timeout, scorer=args.metric, score_sample_size=args.score_sample_size,
+                    fidelities=args.fidelities, cache_bytes=int(args.embedding_cache_mb * 2**20), cache_dir=args.embedding_cache_dir,
+                    level=args.level, db_path=args.db, trace_memory=not args.no_trace_memory,
+                    memo_path=None if args.no_memo else args.memo)
+    configure(**settings)
+
+    footprint = feature_footprint(load_data()[1])
+    print(f"Feature matrix {footprint['shape']}: {footprint['nbytes'] / 2**20:.2f} MiB ({'sparse' if footprint['sparse'] else 'dense'}), "
+          f"{footprint['dense_nbytes'] / 2**20:.2f} MiB as a dense float64 matrix, density {footprint['density']:.3%}")
+
+    study = optuna.create_study(direction="maximize", study_name=args.study_name, storage=make_storage(args.storage), pruner=make_pruner(args.pruner, len(FIDELITIES)), load_if_exists=True)
+    recovered = recover_stale_trials(study)
+    print(f"Study {args.study_name}: {count_finished_trials(study)} finished trials, {recovered} interrupted trials re-enqueued")
+    for path in args.warm_start:
+        # only the number of rows is read while replaying, the fits are not run
+        replay_data = np.empty((load_data()[1].shape[0], 0))
+        seeded = seed_study(study, read_history(path), lambda trial: suggest_pipeline(trial, replay_data), mode=args.warm_start_mode,
+                            top=args.warm_start_top or None, metric=SCORER, level=LEVEL, source=path)
+        print(f"{'Imported' if args.warm_start_mode == 'import' else 'Enqueued'} {seeded} trials from {path}")
+
+    if args.workers > 1:
+        # limit the thread pools in the environment before spawning so each worker starts with bounded pools
+        limit_threads(n_threads)
+        launch_workers(run_worker, args.workers, (args.storage, args.study_name, args.n_trials, n_threads, args.pruner, settings))
+    else:
+        run_worker(args.storage, args.study_name, args.n_trials, n_threads, args.pruner, settings)
+
+    cache_hits = [t.user_attrs["embedding_cache_hit"] for t in study.get_trials(deepcopy=False) if "embedding_cache_hit" in t.user_attrs]
+    if cache_hits:
+        study.set_user_attr("embedding_cache_hit_rate", sum(cache_hits) / len(cache_hits))
+        print(f"Embedding cache hit rate: {sum(cache_hits) / len(cache_hits):.1%} over {len(cache_hits)} trials")
+    memo_hits = sum(t.user_attrs.get("memo_hit", False) for t in study.get_trials(deepcopy=False))
+    if memo_hits:
+        print(f"Score memo answered {memo_hits} trials without fitting")
+
     print(study.best_trial)
     # Print the best parameters and the best score
     print("Best score:", study.best_value)
@@ -145,10 +404,4 @@ if __name__ == "__main__":
 
     # Save dataframe
     session = study.trials_dataframe()
-    session.to_csv("./session.csv")
-
-
-
-
-    
-    
\ No newline at end of file
+    session.to_csv(args.output)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# ISO3 codes and regions of the countries named in the Northwind database, resolved once with country_converter.
+# country_converter matches names against regular expressions, which is slow, so a country name is only converted
+# the first time it appears in the database and the result is kept in the CountryCodes table. The dashboard's queries
+# join CountryCodes for the ISO3 codes of their choropleths instead of converting the names on every rerun.
+import sqlite3
+
+COUNTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS CountryCodes (Country TEXT PRIMARY KEY, ISO3 TEXT, Continent TEXT, Region TEXT);
+"""
+
+# every column holding a country name
+COUNTRY_COLUMNS = [("Customers", "Country"), ("Suppliers", "Country"), ("Employees", "Country"), ("Orders", "ShipCountry")]
+NEW_COUNTRIES = (
+    "SELECT Country FROM (" + " UNION ".join(f"SELECT {column} AS Country FROM {table} WHERE {column} IS NOT NULL" for table, column in COUNTRY_COLUMNS) + ")"
+    " WHERE Country NOT IN (SELECT Country FROM CountryCodes)"
+)
+# the country_converter classifications stored for every country
+CONVERSIONS = {"ISO3": "ISO3", "Continent": "continent", "Region": "UNregion"}
+
+def refresh_country_codes(db_path):
+    """
+    resolves the country names that are not in CountryCodes yet and stores their ISO3 code, continent and UN region
+    names country_converter does not recognize are stored with null codes, so they are not looked up again
+    returns the number of country names resolved
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.executescript(COUNTRY_SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        countries = [row[0] for row in conn.execute(NEW_COUNTRIES)]
+        if countries:
+            # imported here since building the converter alone takes about a second
+            import country_converter as coco
+            converter = coco.CountryConverter()
+            columns = {column: converter.convert(countries, to=to, not_found=None) for column, to in CONVERSIONS.items()}
+            # convert returns a bare value for a single name
+            columns = {column: values if isinstance(values, list) else [values] for column, values in columns.items()}
+            conn.executemany("INSERT INTO CountryCodes (Country, ISO3, Continent, Region) VALUES (?, ?, ?, ?)",
+                             zip(countries, columns["ISO3"], columns["Continent"], columns["Region"]))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(countries)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Resolve the ISO3 codes and regions of the countries in the database")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    args = parser.parse_args()
+    print(f"Resolved {refresh_country_codes(args.db)} new country names into CountryCodes")
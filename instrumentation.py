@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Lightweight per-stage instrumentation of the model search and the dashboard.
+# A stage records its wall time, its CPU time and, when memory tracing is on, the peak of the memory traced by
+# tracemalloc above what was allocated when it started. tracemalloc sees Python and numpy allocations but not those
+# made inside numba or native libraries, and slows Python-heavy stages down, so it can be turned off.
+# The model search stores the measurements of every trial as flat user attributes, <stage>_wall_s, <stage>_cpu_s and
+# <stage>_peak_mb, which end up as columns of session.csv, and the CLI ranks the slowest combinations from it.
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+# the stages of a trial of framework.objective, in the order they run
+TRIAL_STAGES = ["reduce", "cluster", "score"]
+STAGE_FIELDS = ["wall_s", "cpu_s", "peak_mb"]
+
+class StageTimings:
+    """
+    accumulates the measurements of named stages, a stage entered several times adds up its times and keeps its largest peak
+    stages must not be nested when tracing memory, since entering a stage resets the traced peak
+    parameters:
+        trace_memory: whether to trace the peak memory of the stages with tracemalloc
+        thread_cpu: whether to count the CPU time of the calling thread rather than of the whole process,
+            for stages running concurrently in threads, whose memory cannot be told apart and is not traced
+    """
+    def __init__(self, trace_memory=True, thread_cpu=False):
+        self.trace_memory = trace_memory and not thread_cpu
+        self.cpu_clock = time.thread_time if thread_cpu else time.process_time
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        wall, cpu = time.perf_counter(), self.cpu_clock()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, self.cpu_clock() - cpu
+            peak = None
+            if self.trace_memory:
+                peak = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+                if started:
+                    tracemalloc.stop()
+            self.add(name, wall, cpu, peak)
+
+    def add(self, name, wall_s, cpu_s, peak_mb=None):
+        with self._lock:
+            record = self.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_mb": None})
+            record["calls"] += 1
+            record["wall_s"] += wall_s
+            record["cpu_s"] += cpu_s
+            if peak_mb is not None:
+                record["peak_mb"] = max(record["peak_mb"] or 0.0, peak_mb)
+
+    def user_attrs(self):
+        """
+        returns the measurements as flat <stage>_<field> attributes, leaving out the peaks that were not traced
+        """
+        return {f"{name}_{field}": record[field] for name, record in self.stages.items() for field in STAGE_FIELDS if record[field] is not None}
+
+    def frame(self):
+        """
+        returns one row per stage, in the order the stages were first entered
+        """
+        return pd.DataFrame([{"Stage": name, **record} for name, record in self.stages.items()], columns=["Stage", "calls"] + STAGE_FIELDS)
+
+def record_trial(trial, timings):
+    """
+    stores the measurements of a trial as its user attributes
+    """
+    for key, value in timings.user_attrs().items():
+        trial.set_user_attr(key, value)
+
+def slowest_combinations(session, stages=TRIAL_STAGES):
+    """
+    ranks the reducer, clusterer and metric combinations of a study by the mean wall time of their trials
+    returns one row per combination with its number of measured trials, the mean total and per-stage wall times,
+    the mean CPU time and the largest peak memory
+    parameters:
+        session: the trials dataframe of a study, as written to session.csv
+        stages: the stages whose measurements are summed into the total
+    """
+    wall = [f"user_attrs_{stage}_wall_s" for stage in stages if f"user_attrs_{stage}_wall_s" in session]
+    cpu = [f"user_attrs_{stage}_cpu_s" for stage in stages if f"user_attrs_{stage}_cpu_s" in session]
+    peak = [f"user_attrs_{stage}_peak_mb" for stage in stages if f"user_attrs_{stage}_peak_mb" in session]
+    if not wall:
+        return pd.DataFrame()
+    measured = session[session[wall].notna().any(axis=1)]
+    metric = measured["user_attrs_metric"] if "user_attrs_metric" in measured else pd.Series("silhouette", index=measured.index)
+    frame = pd.DataFrame({
+        "Reducer": measured["params_reducer"],
+        "Clusterer": measured["params_clusterer"],
+        "Metric": metric.fillna("silhouette"),
+        "Total_s": measured[wall].sum(axis=1),
+        "CPU_s": measured[cpu].sum(axis=1) if cpu else float("nan"),
+        "Peak_MB": measured[peak].max(axis=1) if peak else float("nan"),
+        **{f"{column[len('user_attrs_'):]}": measured[column] for column in wall},
+    })
+    summary = frame.groupby(["Reducer", "Clusterer", "Metric"]).agg(
+        Trials=("Total_s", "size"),
+        MeanTotal_s=("Total_s", "mean"),
+        MaxTotal_s=("Total_s", "max"),
+        MeanCPU_s=("CPU_s", "mean"),
+        MaxPeak_MB=("Peak_MB", "max"),
+        **{f"Mean_{column[len('user_attrs_'):]}": (column[len('user_attrs_'):], "mean") for column in wall},
+    )
+    return summary.sort_values("MeanTotal_s", ascending=False).reset_index()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Rank the slowest reducer/clusterer/metric combinations of a study from its per-stage measurements")
+    parser.add_argument("--input", default="./session.csv", help="the trials dataframe written by framework.py")
+    parser.add_argument("--top", type=int, default=15, help="the number of combinations printed")
+    parser.add_argument("--output", default=None, help="also write the full ranking to this CSV")
+    args = parser.parse_args()
+    ranking = slowest_combinations(pd.read_csv(args.input))
+    if ranking.empty:
+        parser.error(f"{args.input} has no per-stage measurements, they are recorded by trials of framework.py from this version on")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(ranking.head(args.top).to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    if args.output:
+        ranking.to_csv(args.output, index=False)
+        print(f"Wrote {len(ranking)} combinations to {args.output}")
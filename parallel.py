@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Helpers for running one Optuna study from several worker processes.
+# The workers share the study through a local storage (a journal file or an SQLite database), so every
+# finished trial is persisted as it completes and an interrupted search can be resumed from where it stopped.
+# It also runs individual fits in a killable process to enforce per-trial time limits.
+import os
+import multiprocessing
+from joblib.externals.loky import get_reusable_executor
+from optuna.storages import JournalStorage, RDBStorage
+from optuna.storages.journal import JournalFileBackend
+from optuna.trial import TrialState
+
+DEFAULT_STORAGE = "./optuna-journal.log"
+# environment variables read by the BLAS/OpenMP runtimes and numba when they are first imported
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS"]
+
+def make_storage(storage):
+    """
+    opens an Optuna storage shared between processes
+    parameters:
+        storage: an RDB url such as sqlite:///optuna.db, or the path of a journal file
+    """
+    if "://" in storage:
+        return RDBStorage(storage)
+    return JournalStorage(JournalFileBackend(storage))
+
+def limit_threads(n_threads):
+    """
+    bounds the thread pools of the current process and of the processes it spawns afterwards
+    parameters:
+        n_threads: the number of threads each BLAS, OpenMP and numba pool may use
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    # the pools of libraries that are already imported have to be limited at runtime
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(n_threads)
+    import numba
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+def recover_stale_trials(study):
+    """
+    fails the trials left running by a crashed run and enqueues their parameters again
+    must only be called while no worker is attached to the study
+    parameters:
+        study: the study to recover
+    """
+    stale = study.get_trials(deepcopy=False, states=(TrialState.RUNNING,))
+    # skip_if_exists of enqueue_trial would match the failed trial itself, so only the parameters of the waiting
+    # trials, which are kept as their fixed_params until they run, are compared
+    waiting = [t.system_attrs.get("fixed_params") for t in study.get_trials(deepcopy=False, states=(TrialState.WAITING,))]
+    for trial in stale:
+        study.tell(trial.number, state=TrialState.FAIL)
+        if trial.params not in waiting:
+            study.enqueue_trial(trial.params)
+            waiting.append(trial.params)
+    return len(stale)
+
+def count_finished_trials(study):
+    """
+    counts the trials that consumed search budget
+    parameters:
+        study: the study to inspect
+    """
+    return len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED)))
+
+def launch_workers(target, n_workers, args):
+    """
+    runs target(*args) in n_workers spawned processes and waits for all of them
+    parameters:
+        target: a module-level function, so that it can be pickled
+        n_workers: the number of processes
+        args: the arguments passed to every worker
+    """
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=target, args=args, name=f"optuna-worker-{i}") for i in range(n_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+_warm_executor = None
+
+def _import_estimators():
+    import umap.umap_
+    import sklearn.manifold
+    import sklearn.cluster
+
+def _timeout_executor():
+    global _warm_executor
+    executor = get_reusable_executor(max_workers=1, timeout=600, initializer=_import_estimators)
+    if executor is not _warm_executor:
+        # start the process and import the estimators before any trial's clock starts
+        executor.submit(int).result()
+        _warm_executor = executor
+    return executor
+
+def run_with_timeout(func, *args, timeout=None):
+    """
+    calls func(*args) in a separate process and kills it if it runs longer than timeout seconds
+    the process is reused between calls, so only the arguments and the result are shipped per call
+    parameters:
+        func: a picklable callable, such as the bound fit method of an estimator
+        args: the arguments of func
+        timeout: the time limit in seconds, or None to call func in this process
+    """
+    if timeout is None:
+        return func(*args)
+    if timeout <= 0:
+        raise TimeoutError("no time left")
+    executor = _timeout_executor()
+    future = executor.submit(func, *args)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        # native code cannot be interrupted, so the only way to stop a runaway fit is to kill its process
+        executor.shutdown(wait=False, kill_workers=True)
+        raise
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# A cluster scatter whose browser payload stays bounded as the number of rows grows.
+# Small projections are drawn point by point as SVG, larger ones with WebGL on a stratified sample that keeps
+# every point of the small clusters, and the largest ones are binned server side into tiles per cluster,
+# shaded by the number of rows they hold.
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objs as go
+
+# up to this many rows every point is drawn as SVG
+WEBGL_THRESHOLD = 10000
+# up to this many rows the points are drawn with WebGL, beyond it they are binned into tiles
+DENSITY_THRESHOLD = 200000
+# the number of points a WebGL scatter draws at most
+MAX_POINTS = 50000
+# every cluster keeps at least this many points when sampling, or all of them when it is smaller
+MIN_PER_CLUSTER = 500
+# the number of tiles along each axis of the density mode
+TILE_BINS = 150
+
+def scatter_mode(n_rows):
+    """
+    returns how a scatter of n_rows points is rendered: "svg", "webgl" or "density"
+    """
+    if n_rows <= WEBGL_THRESHOLD:
+        return "svg"
+    if n_rows <= DENSITY_THRESHOLD:
+        return "webgl"
+    return "density"
+
+def stratified_sample(df, n, column="Cluster", min_per_cluster=MIN_PER_CLUSTER, random_state=0):
+    """
+    samples about n rows in proportion to the cluster sizes, keeping at least min_per_cluster rows of every cluster
+    parameters:
+        df: the frame to sample
+        n: the number of rows to keep
+        column: the cluster column
+        min_per_cluster: the rows every cluster keeps, all of them for smaller clusters
+        random_state: the seed of the sample
+    """
+    if len(df) <= n:
+        return df
+    codes, _ = pd.factorize(df[column])
+    sizes = np.bincount(codes)
+    quotas = np.maximum(np.round(sizes * n / len(df)), np.minimum(sizes, min_per_cluster)).astype(int)
+    # rank the rows of every cluster in a random order and keep the first quota of them
+    order = np.random.default_rng(random_state).permutation(len(df))
+    ranks = np.empty(len(df), dtype=np.int64)
+    ranks[order] = pd.Series(codes[order]).groupby(codes[order]).cumcount().to_numpy()
+    return df[ranks < quotas[codes]]
+
+def density_tiles(df, x="UMAP1", y="UMAP2", column="Cluster", bins=TILE_BINS):
+    """
+    counts the rows of every cluster in a bins x bins grid over the projection
+    returns one row per occupied tile and cluster with the tile center and the count
+    """
+    xs, ys = df[x].to_numpy(), df[y].to_numpy()
+    x0, y0 = xs.min(), ys.min()
+    width = max(xs.max() - x0, 1e-12) / bins
+    height = max(ys.max() - y0, 1e-12) / bins
+    ix = np.minimum(((xs - x0) / width).astype(np.int64), bins - 1)
+    iy = np.minimum(((ys - y0) / height).astype(np.int64), bins - 1)
+    codes, clusters = pd.factorize(df[column], sort=True)
+    keys, counts = np.unique((codes * bins + ix) * bins + iy, return_counts=True)
+    return pd.DataFrame({
+        column: clusters[keys // (bins * bins)],
+        x: x0 + (keys // bins % bins + 0.5) * width,
+        y: y0 + (keys % bins + 0.5) * height,
+        "Count": counts,
+    })
+
+def choropleth(iso3, z, height=300):
+    """
+    draws a value per country on an orthographic globe
+    parameters:
+        iso3: the ISO3 code of every country, countries without one are left out
+        z: the value of every country
+    """
+    layout = dict(geo={'scope': "world"})
+    data = dict(
+        type='choropleth',
+        locations=iso3,
+        locationmode='ISO-3',
+        colorscale='Viridis',
+        z=z)
+    fig = go.Figure(data=[data], layout=layout)
+    fig.update_geos(projection_type="orthographic")
+    fig.update_layout(height=height, margin={"r":0,"t":0,"l":0,"b":0})
+    return fig
+
+def cluster_scatter(df, x="UMAP1", y="UMAP2", color="Cluster", mode=None):
+    """
+    draws a 2d projection colored by cluster, rendered according to scatter_mode
+    parameters:
+        df: the projection, with the x, y and color columns
+        mode: "svg", "webgl" or "density", chosen from the number of rows when None
+    """
+    mode = mode or scatter_mode(len(df))
+    category_orders = {color: sorted(df[color].unique())}
+    if mode == "svg":
+        return px.scatter(df, x=x, y=y, color=color, size_max=10, category_orders=category_orders)
+    if mode == "webgl":
+        sample = stratified_sample(df, MAX_POINTS, column=color)
+        return px.scatter(sample, x=x, y=y, color=color, size_max=10, category_orders=category_orders, render_mode="webgl")
+
+    tiles = density_tiles(df, x, y, color)
+    palette = px.colors.qualitative.Plotly
+    fig = go.Figure(layout=dict(legend_title_text=color, xaxis_title=x, yaxis_title=y))
+    shade = np.log1p(tiles["Count"].to_numpy()) / np.log1p(tiles["Count"].max())
+    for i, cluster in enumerate(category_orders[color]):
+        mask = (tiles[color] == cluster).to_numpy()
+        fig.add_trace(go.Scattergl(
+            x=tiles[x][mask], y=tiles[y][mask], name=str(cluster), mode="markers",
+            marker=dict(symbol="square", size=4, color=palette[i % len(palette)], opacity=0.25 + 0.75 * shade[mask]),
+            customdata=tiles["Count"][mask], hovertemplate="%{customdata} rows<extra>" + str(cluster) + "</extra>",
+        ))
+    return fig
+
+if __name__ == "__main__":
+    import argparse
+    from segmentation import MODEL_PATH, load_segmentation
+    parser = argparse.ArgumentParser(description="Export the persisted segmentation's cluster scatter as a standalone HTML page")
+    parser.add_argument("--model", default=MODEL_PATH, help="where the segmentation artifact is persisted")
+    parser.add_argument("--mode", choices=["svg", "webgl", "density"], default=None, help="the rendering mode, chosen from the number of rows by default")
+    parser.add_argument("--output", default="./temp-plot.html", help="where the page is written")
+    args = parser.parse_args()
+    model = load_segmentation(args.model)
+    if model is None:
+        parser.error(f"no segmentation at {args.model}, fit one with segmentation.py first")
+    # plotly.js is loaded from its CDN rather than inlined in every export
+    cluster_scatter(model["df_plot"], mode=args.mode).write_html(args.output, include_plotlyjs="cdn")
+    print(f"Wrote the {args.mode or scatter_mode(len(model['df_plot']))} scatter of {len(model['df_plot'])} rows to {args.output}")
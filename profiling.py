@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Per-cluster profiles of the order lines, computed with grouped aggregations over the whole frame.
+# Dates are parsed once for the whole column and categorical columns are grouped on their integer codes,
+# so the cost is a few linear passes whatever the number of clusters, with no per-row Python code and no
+# per-cluster copies of the data. The profiles are written to a parquet file the dashboard reads.
+import os
+import numpy as np
+import pandas as pd
+
+PROFILES_PATH = "./cache/cluster_profiles.parquet"
+# the columns whose most lucrative values are listed in the profiles
+TOP_COLUMNS = {"TopCategories": "CategoryName", "TopProducts": "ProductName", "TopCountries": "CustomerCountry"}
+
+def _top_values(frame, column, top_n):
+    # spend per cluster and value, grouped on the category codes
+    values = pd.Categorical(frame[column])
+    spend = frame.groupby([frame["Cluster"], values.codes])["TotalPrice"].sum()
+    spend = spend[spend.index.get_level_values(1) >= 0]
+    top = spend.sort_values(ascending=False, kind="stable").groupby(level=0).head(top_n)
+    names = pd.Series(values.categories[top.index.get_level_values(1)], index=top.index.get_level_values(0))
+    return names.groupby(level=0).agg(list)
+
+def profile_clusters(data, labels, names=None, top_n=3):
+    """
+    profiles every cluster in a single grouped pass per statistic
+    returns one row per cluster with its size, spend, quantity and discount statistics, its top categories,
+    products and customer countries by spend, and the share of its spend falling in each calendar month
+    parameters:
+        data: the order lines, with the OrderDate, TotalPrice, Quantity, Discount and TOP_COLUMNS columns
+        labels: the cluster label of every order line
+        names: the display name of every cluster label, if any
+        top_n: the number of top values listed per column
+    """
+    frame = pd.DataFrame({
+        "Cluster": np.asarray(labels),
+        "Month": pd.to_datetime(data["OrderDate"], format="%Y-%m-%d").dt.month.to_numpy(),
+        "TotalPrice": data["TotalPrice"].to_numpy(),
+        "Quantity": data["Quantity"].to_numpy(),
+        "Discount": data["Discount"].to_numpy(),
+        **{column: data[column].to_numpy() for column in TOP_COLUMNS.values()},
+    })
+    frame["Discounted"] = frame["Discount"] > 0
+
+    profiles = frame.groupby("Cluster").agg(
+        OrderLines=("TotalPrice", "size"),
+        Spend=("TotalPrice", "sum"),
+        MeanSpend=("TotalPrice", "mean"),
+        MedianSpend=("TotalPrice", "median"),
+        MeanQuantity=("Quantity", "mean"),
+        MeanDiscount=("Discount", "mean"),
+        DiscountedShare=("Discounted", "mean"),
+    )
+    profiles.insert(2, "SpendShare", profiles["Spend"] / profiles["Spend"].sum())
+    for profile_column, column in TOP_COLUMNS.items():
+        profiles[profile_column] = _top_values(frame, column, top_n)
+
+    monthly = frame.pivot_table(index="Cluster", columns="Month", values="TotalPrice", aggfunc="sum", fill_value=0.0)
+    monthly = monthly.reindex(columns=range(1, 13), fill_value=0.0)
+    seasonality = monthly.div(monthly.sum(axis=1), axis=0)
+    profiles["Seasonality"] = list(seasonality.to_numpy())
+    profiles["PeakMonth"] = seasonality.to_numpy().argmax(axis=1) + 1
+
+    profiles = profiles.reset_index()
+    if names is not None:
+        profiles.insert(1, "ClusterName", [names[label] for label in profiles["Cluster"]])
+    return profiles
+
+def write_profiles(profiles, path=PROFILES_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    profiles.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def read_profiles(path=PROFILES_PATH):
+    """
+    reads the profiles written by write_profiles, or returns None if there are none
+    """
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# The SQL behind every chart of the dashboard, grouped by tab. The sales figures are read from the
+# pre-aggregated sales cube, see cube.py, and the ISO3 codes of the maps from CountryCodes, see geo.py.
+# The order lines themselves are read from the columnar extract, see extract.py.
+
+SALES_QUERIES = {
+    "monthly_sales": 'SELECT Month, Sales AS MonthlySales FROM SalesByMonth ORDER BY Month;',
+    "category_sales": 'SELECT CategoryName AS Category, Sales AS SalesByCategory FROM SalesByCategory;',
+    "region_sales": 'SELECT ShipCountry, Sales AS SalesByRegion, CountryCodes.Region, CountryCodes.ISO3 FROM SalesByCountry LEFT JOIN CountryCodes ON SalesByCountry.ShipCountry = CountryCodes.Country;',
+    "top_10_sales": 'SELECT ProductName, Sales FROM SalesByProduct ORDER BY Sales DESC LIMIT 10;',
+    "employee_sales": 'SELECT EmployeeName, Sales AS SalesByEmployee FROM SalesByEmployee;',
+}
+CUSTOMERS_QUERIES = {
+    "top_customers": 'SELECT CustomerID AS CustomerName, Sales AS TotalOrder FROM SalesByCustomer ORDER BY Sales DESC LIMIT 10',
+    "geographic_distribution": 'SELECT Customers.Country, COUNT(*) AS NumCustomers, CountryCodes.ISO3 FROM Customers LEFT JOIN CountryCodes ON Customers.Country = CountryCodes.Country GROUP BY Customers.Country',
+    "orders_by_customer": 'SELECT CustomerID AS CustomerName, NumOrders AS TotalOrder FROM SalesByCustomer ORDER BY NumOrders DESC',
+}
+SUPPLIERS_QUERIES = {
+    "supplier_distribution": "SELECT Suppliers.Country, COUNT(*) AS NumSuppliers, CountryCodes.ISO3 FROM Suppliers LEFT JOIN CountryCodes ON Suppliers.Country = CountryCodes.Country GROUP BY Suppliers.Country",
+    "products_by_supplier": "SELECT CompanyName, COUNT(*) AS NumProducts FROM Products INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID GROUP BY Suppliers.SupplierID",
+    "inventory_levels": "SELECT CompanyName, SUM(UnitsInStock) AS Inventory FROM Products INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID GROUP BY Suppliers.SupplierID",
+    "orders_by_suppliers": "SELECT CompanyName, NumOrders FROM SalesBySupplier",
+}
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# A bandit scheduler over the reducer x clusterer pairs of the model search.
+# Every pair is an arm with its own sub-study, whose sampler keeps the reducer and the clusterer fixed and tunes
+# the remaining parameters with TPE, so one arm's slow or failing configurations do not shape the others' search.
+# Trials go to the arm with the highest index, the recent improvement of its best score per trial plus an
+# exploration bonus, divided by its recent seconds per fitted trial. Pruned trials and memo hits are not fits, so
+# they count as trials but not towards the cost, which is never taken below that of the fastest arm. An arm that another one beats on both its best score
+# and its cost per trial is retired, as is an arm without a single scored trial. The sub-studies live in the
+# shared storage, so a run resumes the arms, their scores and their retirements where the last one stopped.
+import math
+import time
+import optuna
+import numpy as np
+import pandas as pd
+from optuna.trial import TrialState
+from framework import REDUCERS, CLUSTERERS, objective, configure
+from feature_store import refresh_features
+from extract import refresh_extract
+from parallel import DEFAULT_STORAGE, make_storage, recover_stale_trials
+from scoring import SCORERS
+from warm_start import MEMO_PATH
+
+ARMS = [(reducer, clusterer) for reducer in REDUCERS for clusterer in CLUSTERERS]
+# every arm gets this many trials before the index decides
+MIN_TRIALS = 2
+# an arm is only retired, or used to retire another, once it has run this many trials
+RETIRE_AFTER = 5
+# the number of most recent trials of an arm its improvement and cost are measured over
+WINDOW = 5
+# the weight of the exploration bonus, in units of the spread of the arms' best scores
+EXPLORATION = 0.5
+# the gain per trial assumed for an arm with fewer than min_trials scored trials, in units of the spread of the arms' best scores
+PRIOR_GAIN = 0.5
+# the cost per trial assumed before any arm has fitted a configuration, and the least ever assumed, in seconds
+MIN_FIT_SECONDS = 0.1
+FINISHED = (TrialState.COMPLETE, TrialState.PRUNED, TrialState.FAIL)
+
+class Arm:
+    """
+    a reducer and clusterer pair with its sub-study
+    parameters:
+        reducer: one of framework.REDUCERS
+        clusterer: one of framework.CLUSTERERS
+        study: the sub-study of the arm, sampled with the pair fixed
+    """
+    def __init__(self, reducer, clusterer, study):
+        self.reducer = reducer
+        self.clusterer = clusterer
+        self.study = study
+
+    @property
+    def name(self):
+        return f"{self.reducer}+{self.clusterer}"
+
+    @property
+    def retired(self):
+        return self.study.user_attrs.get("retired")
+
+    def retire(self, reason):
+        self.study.set_user_attr("retired", reason)
+
+    def stats(self, window=WINDOW):
+        """
+        returns the trial counts, scores and costs of the arm, its best score is None until a trial is scored
+        the mean and recent seconds are those of the scored trials that were not served from the memo, and None until there is one
+        """
+        trials = [t for t in self.study.get_trials(deepcopy=False) if t.state in FINISHED]
+        seconds = np.array([t.duration.total_seconds() if t.duration is not None else 0.0 for t in trials])
+        fitted = seconds[[t.state == TrialState.COMPLETE and not t.user_attrs.get("memo_hit") for t in trials]] if trials else seconds
+        scores = [t.value if t.state == TrialState.COMPLETE else None for t in trials]
+        # the best score after every trial, None before the first scored one
+        running, best = [], None
+        for score in scores:
+            if score is not None and (best is None or score > best):
+                best = score
+            running.append(best)
+        recent = slice(max(0, len(trials) - window), len(trials))
+        before = running[recent.start - 1] if recent.start > 0 else None
+        start = before if before is not None else next((b for b in running[recent] if b is not None), None)
+        n_recent = len(trials) - recent.start
+        completed = [s for s in scores if s is not None]
+        return {
+            "trials": len(trials),
+            "complete": len(completed),
+            "pruned": sum(t.state == TrialState.PRUNED for t in trials),
+            # the objective returns -1 when a fit raises
+            "errors": sum(s == -1 for s in completed),
+            "failed": sum(s == -1 for s in completed) + sum(t.state == TrialState.FAIL for t in trials),
+            "best": best,
+            "mean_score": float(np.mean(completed)) if completed else None,
+            "seconds": float(seconds.sum()),
+            "fitted": len(fitted),
+            "mean_seconds": float(fitted.mean()) if len(fitted) else None,
+            "recent_gain": (best - start) / n_recent if best is not None and start is not None and n_recent else 0.0,
+            "recent_seconds": float(fitted[-window:].mean()) if len(fitted) else None,
+        }
+
+def open_arms(storage, prefix, seed=None):
+    """
+    creates or resumes the sub-study of every arm, named <prefix>/<reducer>+<clusterer>
+    """
+    arms = []
+    for i, (reducer, clusterer) in enumerate(ARMS):
+        sampler = optuna.samplers.PartialFixedSampler({"reducer": reducer, "clusterer": clusterer},
+                                                      optuna.samplers.TPESampler(seed=None if seed is None else seed + i))
+        study = optuna.create_study(direction="maximize", study_name=f"{prefix}/{reducer}+{clusterer}", storage=storage, sampler=sampler, load_if_exists=True)
+        recover_stale_trials(study)
+        arms.append(Arm(reducer, clusterer, study))
+    return arms
+
+def arm_index(stats, n_total, spread, min_seconds, min_trials=MIN_TRIALS, exploration=EXPLORATION):
+    """
+    the expected improvement of an arm's best score per second of its next trial, with an optimistic bonus for
+    arms that ran few trials
+    an arm with fewer than min_trials scored trials has no improvement to measure yet and gets PRIOR_GAIN instead,
+    an arm without a fitted trial gets the cost min_seconds, as does one faster than that
+    """
+    gain = stats["recent_gain"] if stats["complete"] - stats["errors"] >= min_trials else PRIOR_GAIN * spread
+    bonus = exploration * spread * math.sqrt(math.log(max(n_total, 2)) / max(stats["trials"], 1))
+    return (gain + bonus) / max(stats["recent_seconds"] or 0.0, min_seconds)
+
+def choose_arm(arms, min_trials=MIN_TRIALS, exploration=EXPLORATION):
+    """
+    returns the arm the next trial goes to, arms below min_trials first, then the one with the highest index
+    """
+    stats = {arm.name: arm.stats() for arm in arms}
+    fresh = [arm for arm in arms if stats[arm.name]["trials"] < min_trials]
+    if fresh:
+        return min(fresh, key=lambda arm: stats[arm.name]["trials"])
+    bests = [s["best"] for s in stats.values() if s["best"] is not None]
+    spread = (max(bests) - min(bests)) if len(bests) > 1 and max(bests) > min(bests) else 1.0
+    n_total = sum(s["trials"] for s in stats.values())
+    # the fastest arm's recent cost, a real fit, so an arm whose trials were mostly pruned or memoized is not scheduled as if free
+    costs = [s["recent_seconds"] for s in stats.values() if s["recent_seconds"] is not None]
+    min_seconds = max(min(costs, default=MIN_FIT_SECONDS), MIN_FIT_SECONDS)
+    return max(arms, key=lambda arm: arm_index(stats[arm.name], n_total, spread, min_seconds, min_trials, exploration))
+
+def retire_dominated(arms, retire_after=RETIRE_AFTER):
+    """
+    retires the active arms without any scored trial, and those another arm beats on best score and cost per trial,
+    once both have run retire_after trials
+    returns the arms retired
+    """
+    stats = {arm.name: arm.stats() for arm in arms}
+    ready = [arm for arm in arms if stats[arm.name]["trials"] >= retire_after]
+    retired = []
+    for arm in ready:
+        s = stats[arm.name]
+        if s["best"] is None or s["complete"] == s["errors"]:
+            arm.retire(f"no scored trial in {s['trials']}")
+            retired.append(arm)
+            continue
+        for other in ready:
+            o = stats[other.name]
+            if other is arm or o["best"] is None or other in retired or o["mean_seconds"] is None or s["mean_seconds"] is None:
+                continue
+            if o["best"] >= s["best"] and o["mean_seconds"] <= s["mean_seconds"] and (o["best"] > s["best"] or o["mean_seconds"] < s["mean_seconds"]):
+                arm.retire(f"dominated by {other.name}")
+                retired.append(arm)
+                break
+    return retired
+
+def run_scheduler(arms, n_trials, timeout=None, min_trials=MIN_TRIALS, retire_after=RETIRE_AFTER, exploration=EXPLORATION):
+    """
+    runs up to n_trials trials, one at a time, on the arm chosen by choose_arm, retiring dominated arms after each
+    parameters:
+        arms: the arms, see open_arms, the retired ones are skipped
+        n_trials: the number of trials of this run
+        timeout: the wall-clock budget of this run in seconds, or None
+        min_trials: the trials every arm gets before the index decides
+        retire_after: the trials an arm runs before it can be retired
+        exploration: the weight of the exploration bonus
+    """
+    start = time.monotonic()
+    for _ in range(n_trials):
+        active = [arm for arm in arms if not arm.retired]
+        if not active or (timeout is not None and time.monotonic() - start > timeout):
+            break
+        arm = choose_arm(active, min_trials, exploration)
+        arm.study.optimize(objective, n_trials=1)
+        for retired in retire_dominated(active, retire_after):
+            print(f"Retired {retired.name}: {retired.retired}")
+
+def summarize_arms(arms):
+    """
+    returns the cost and quality of every arm, best arms first
+    """
+    rows = []
+    for arm in arms:
+        s = arm.stats()
+        rows.append({
+            "Reducer": arm.reducer,
+            "Clusterer": arm.clusterer,
+            "Trials": s["trials"],
+            "Complete": s["complete"],
+            "Pruned": s["pruned"],
+            "Failed": s["failed"],
+            "BestScore": s["best"],
+            "MeanScore": s["mean_score"],
+            "TotalSeconds": s["seconds"],
+            "MeanSeconds": s["mean_seconds"],
+            "Status": arm.retired or "active",
+        })
+    return pd.DataFrame(rows).sort_values("BestScore", ascending=False, na_position="last").reset_index(drop=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Allocate search trials across the reducer x clusterer pairs as a bandit")
+    parser.add_argument("--level", choices=["customers", "order_lines"], default="customers", help="cluster the customers of the feature store or the one-hot encoded order lines")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database the feature store or the order line extract is refreshed from")
+    parser.add_argument("--n-trials", type=int, default=150, help="the number of trials of this run, shared by the arms")
+    parser.add_argument("--timeout", type=float, default=None, help="stop scheduling new trials after this many seconds")
+    parser.add_argument("--trial-timeout", type=float, default=None, help="kill the fits of a trial after this many seconds and prune it")
+    parser.add_argument("--metric", choices=SCORERS, default="silhouette", help="cluster quality score to maximize, davies_bouldin is negated")
+    parser.add_argument("--min-trials", type=int, default=MIN_TRIALS, help="the trials every arm gets before the index decides")
+    parser.add_argument("--retire-after", type=int, default=RETIRE_AFTER, help="the trials an arm runs before it can be retired")
+    parser.add_argument("--exploration", type=float, default=EXPLORATION, help="the weight of the exploration bonus")
+    parser.add_argument("--memo", default=MEMO_PATH, help="the SQLite file of the score memo")
+    parser.add_argument("--no-memo", action="store_true", help="evaluate every configuration, even one scored before")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the arms' samplers")
+    parser.add_argument("--storage", default=DEFAULT_STORAGE, help="journal file or RDB url holding the sub-studies")
+    parser.add_argument("--study-name", default=None, help="prefix of the sub-study names, northwind-customers-arms or northwind-arms by level")
+    parser.add_argument("--output", default="./arm_summary.csv", help="where the per-arm summary is written")
+    args = parser.parse_args()
+    prefix = args.study_name or ("northwind-customers-arms" if args.level == "customers" else "northwind-arms")
+    if args.level == "customers":
+        refresh_features(args.db)
+    else:
+        refresh_extract(args.db)
+    configure(trial_timeout=args.trial_timeout, scorer=args.metric, level=args.level, db_path=args.db, memo_path=None if args.no_memo else args.memo)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    arms = open_arms(make_storage(args.storage), prefix, seed=args.seed)
+    print(f"{sum(not arm.retired for arm in arms)} of {len(arms)} arms active in {prefix}")
+    run_scheduler(arms, args.n_trials, timeout=args.timeout, min_trials=args.min_trials, retire_after=args.retire_after, exploration=args.exploration)
+
+    summary = summarize_arms(arms)
+    summary.to_csv(args.output, index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    print(f"Wrote the summary of {len(summary)} arms to {args.output}")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Cluster quality scores that scale past a few thousand rows.
+# The silhouette is computed row block by row block against the whole embedding. As with sklearn's working_memory,
+# the block size is derived from a byte budget, so the distances held at once stay within WORKING_MEMORY whatever
+# the number of rows, down to a single row of n_samples distances; it can be evaluated exactly or estimated from a
+# random sample of rows with a confidence interval. Calinski-Harabasz and Davies-Bouldin are linear time alternatives.
+import numpy as np
+from scipy import sparse, stats
+from sklearn.metrics import pairwise_distances, calinski_harabasz_score, davies_bouldin_score
+
+SCORERS = ["silhouette", "sampled_silhouette", "calinski_harabasz", "davies_bouldin"]
+# the bytes of the block of float64 distances the silhouette holds at once, the temporaries of pairwise_distances
+# take about as much again
+WORKING_MEMORY = 64 * 2**20
+
+def _encode_labels(labels, n_samples):
+    classes, codes = np.unique(labels, return_inverse=True)
+    if not 2 <= len(classes) <= n_samples - 1:
+        raise ValueError(f"Number of labels is {len(classes)}. Valid values are 2 to n_samples - 1 (inclusive)")
+    return codes, len(classes)
+
+def _chunk_size(n_samples, chunk_size):
+    # the rows of a block, each holds n_samples float64 distances
+    return chunk_size or max(1, WORKING_MEMORY // (8 * max(n_samples, 1)))
+
+def silhouette_values(X, labels, rows=None, chunk_size=None, metric="euclidean"):
+    """
+    computes the silhouette of the given rows against every point of the embedding
+    parameters:
+        X: the embeddings
+        labels: the cluster label of every row of X
+        rows: the indices of the rows to compute, defaults to all of them
+        chunk_size: the number of rows whose distances are held in memory at once, by default as many as fit in WORKING_MEMORY
+        metric: the distance metric
+    """
+    n_samples = X.shape[0]
+    chunk_size = _chunk_size(n_samples, chunk_size)
+    codes, n_clusters = _encode_labels(labels, n_samples)
+    counts = np.bincount(codes, minlength=n_clusters)
+    membership = sparse.csr_matrix((np.ones(n_samples), (np.arange(n_samples), codes)), shape=(n_samples, n_clusters))
+    rows = np.arange(n_samples) if rows is None else np.asarray(rows)
+
+    values = np.empty(len(rows))
+    for start in range(0, len(rows), chunk_size):
+        block = rows[start:start + chunk_size]
+        distances = pairwise_distances(X[block], X, metric=metric)
+        # summed distance from every row of the block to every cluster
+        sums = np.asarray((membership.T @ distances.T).T)
+        own = codes[block]
+        index = np.arange(len(block))
+        a = sums[index, own] / np.maximum(counts[own] - 1, 1)
+        sums[index, own] = np.inf
+        b = np.min(sums / counts, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            s = (b - a) / np.maximum(a, b)
+        # singleton clusters score 0 by definition
+        values[start:start + len(block)] = np.where(counts[own] > 1, np.nan_to_num(s), 0.0)
+    return values
+
+def chunked_silhouette(X, labels, chunk_size=None, metric="euclidean"):
+    """
+    exact mean silhouette with memory bounded by chunk_size x n_samples distances, WORKING_MEMORY bytes by default
+    """
+    return float(np.mean(silhouette_values(X, labels, chunk_size=chunk_size, metric=metric)))
+
+def sampled_silhouette(X, labels, sample_size=2000, confidence=0.95, random_state=None, chunk_size=None, metric="euclidean"):
+    """
+    estimates the mean silhouette from the exact silhouette of a random sample of rows
+    returns the estimate and the bounds of its confidence interval, which collapse to the estimate once the sample covers all rows
+    parameters:
+        X: the embeddings
+        labels: the cluster label of every row of X
+        sample_size: the number of rows to sample
+        confidence: the coverage of the confidence interval
+        random_state: the seed of the row sample
+    """
+    n_samples = X.shape[0]
+    if sample_size >= n_samples:
+        score = chunked_silhouette(X, labels, chunk_size=chunk_size, metric=metric)
+        return score, score, score
+    rows = np.random.default_rng(random_state).choice(n_samples, size=sample_size, replace=False)
+    values = silhouette_values(X, labels, rows=rows, chunk_size=chunk_size, metric=metric)
+    estimate = float(np.mean(values))
+    # standard error of the mean with the finite population correction of sampling without replacement
+    error = np.std(values, ddof=1) / np.sqrt(sample_size) * np.sqrt((n_samples - sample_size) / (n_samples - 1))
+    margin = stats.norm.ppf(0.5 + confidence / 2) * error
+    return estimate, float(estimate - margin), float(estimate + margin)
+
+def score_clusters(X, labels, metric="silhouette", sample_size=2000, random_state=None):
+    """
+    scores a clustering so that higher is better
+    returns the score and, for the sampled silhouette, its confidence interval (None otherwise)
+    parameters:
+        X: the embeddings
+        labels: the cluster label of every row of X
+        metric: one of SCORERS, davies_bouldin is negated since lower values are better
+        sample_size: the number of rows of the sampled silhouette
+        random_state: the seed of the sampled silhouette
+    """
+    if metric == "silhouette":
+        return chunked_silhouette(X, labels), None
+    if metric == "sampled_silhouette":
+        estimate, low, high = sampled_silhouette(X, labels, sample_size=sample_size, random_state=random_state)
+        return estimate, (low, high)
+    _encode_labels(labels, X.shape[0])
+    if metric == "calinski_harabasz":
+        return float(calinski_harabasz_score(X, labels)), None
+    if metric == "davies_bouldin":
+        return -float(davies_bouldin_score(X, labels)), None
+    raise ValueError(f"unknown metric {metric}, expected one of {SCORERS}")
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# The customer segmentation model shown on the dashboard, persisted as a versioned artifact.
+# The artifact holds the fitted encoder, PCA, clusterer and 2d UMAP along with the labels and the projection,
+# and records a fingerprint of the database it was fitted on, so it is only refitted when the data changes.
+# New orders are assigned to the fitted segments without refitting, and drift statistics of those
+# assignments tell when a refit is worth it.
+import os
+import hashlib
+import sqlite3
+import warnings
+import joblib
+import numpy as np
+import pandas
+from utils import LABEL_NAMES, make_encoder, encode, fit_reduce_and_cluster, label_clusters
+
+# bump whenever the preprocessing, the model parameters or the artifact layout change
+MODEL_VERSION = 2
+MODEL_PATH = "./cache/segmentation.joblib"
+
+ORDER_LINES_SELECT = 'SELECT Orders.OrderID, Orders.OrderDate, Orders.ShippedDate, Customers.Country AS CustomerCountry, Customers.City AS CustomerCity, Customers.Region AS CustomerRegion, Products.ProductID, Products.ProductName, Products.CategoryID, [Order Details].UnitPrice, [Order Details].Quantity, [Order Details].Discount, Categories.CategoryName, Suppliers.Country AS SupplierCountry, Suppliers.Region AS SupplierRegion, ([Order Details].UnitPrice * [Order Details].Quantity) - ([Order Details].UnitPrice * [Order Details].Quantity * [Order Details].Discount) AS TotalPrice FROM Orders INNER JOIN Customers ON Orders.CustomerID = Customers.CustomerID INNER JOIN [Order Details] ON Orders.OrderID = [Order Details].OrderID INNER JOIN Products ON [Order Details].ProductID = Products.ProductID INNER JOIN Categories ON Products.CategoryID = Categories.CategoryID INNER JOIN Suppliers ON Products.SupplierID = Suppliers.SupplierID'
+ORDER_LINES_FILTER = ' WHERE Orders.OrderDate BETWEEN \'2010-01-01\' AND \'2020-12-31\''
+ORDER_LINES_QUERY = ORDER_LINES_SELECT + ORDER_LINES_FILTER + ' ORDER BY Orders.OrderDate;'
+# the order lines of the orders placed after a given OrderID, in the order they were placed, within the dates of ORDER_LINES_QUERY
+NEW_ORDER_LINES_QUERY = ORDER_LINES_SELECT + ORDER_LINES_FILTER + ' AND Orders.OrderID > ? ORDER BY Orders.OrderID;'
+# cheap aggregates that change whenever an order, an order line or a referenced dimension row changes
+FINGERPRINT_QUERIES = [
+    'SELECT COUNT(*), MAX(OrderID), MAX(OrderDate), MAX(ShippedDate) FROM Orders',
+    'SELECT COUNT(*), SUM(Quantity), SUM(UnitPrice * Quantity), SUM(Discount) FROM [Order Details]',
+    'SELECT COUNT(*), MAX(ProductID) FROM Products',
+    'SELECT COUNT(*) FROM Customers',
+    'SELECT COUNT(*) FROM Suppliers',
+]
+
+# columns to be transformed by one-hot encoder
+COLS_TO_TRANSFORM = ['OrderDate', 'ShippedDate', 'CustomerCountry', 'CustomerCity', 'CustomerRegion', 'ProductName', 'CategoryName', 'SupplierCountry', 'SupplierRegion']
+COLS_TO_RETAIN = ['TotalPrice', 'UnitPrice', 'Quantity', 'Discount']
+
+PCA_PARAMS = {
+    'n_components': 5,
+    'whiten': False,
+    'svd_solver': 'randomized',
+    'tol': 8,
+    'n_oversamples': 4,
+    'power_iteration_normalizer': 'none',
+    'random_state': 8
+}
+
+KMEANS_PARAMS = {
+    'n_clusters': 7,
+    'init': "k-means++",
+    'n_init': 10,
+    'tol': 1.0,
+    'size_min': 120,
+    'random_state': 8
+}
+
+UMAP_PARAMS = {
+    'n_neighbors': 75,
+    'min_dist': 0.50,
+    'n_components': 2,
+    'random_state': 8
+}
+
+# new orders always carry order and ship dates the encoder has not seen, which it maps to the infrequent
+# category like most training dates, so only the other categorical columns count as unseen categories
+DRIFT_COLUMNS = [col for col in COLS_TO_TRANSFORM if col not in ('OrderDate', 'ShippedDate')]
+# a refit is due once any drift statistic of the assigned rows exceeds its threshold
+DRIFT_THRESHOLDS = {
+    "unknown_share": 0.05,
+    "distance_ratio": 1.5,
+    "proportion_shift": 0.2,
+}
+
+def data_fingerprint(db_path):
+    """
+    hashes a handful of aggregates of the database, which is far cheaper than reading the order lines
+    parameters:
+        db_path: the path of the SQLite database
+    """
+    digest = hashlib.sha256()
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        for query in FINGERPRINT_QUERIES:
+            digest.update(repr(conn.execute(query).fetchall()).encode())
+    return digest.hexdigest()
+
+def read_order_lines(db_path):
+    """
+    reads the order lines the segmentation is fitted on, as in the dashboard
+    """
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        return pandas.read_sql(ORDER_LINES_QUERY, conn)
+
+def prepare(customer_data):
+    # drop incomplete rows and the ID columns
+    return customer_data.dropna().drop(['OrderID', 'ProductID', 'CategoryID'], axis=1)
+
+def nearest_centroid(embeddings, centers):
+    """
+    returns the index of the nearest centroid of every row and the distance to it
+    """
+    distances = np.linalg.norm(embeddings[:, None, :] - centers[None, :, :], axis=2)
+    segments = distances.argmin(axis=1)
+    return segments, distances[np.arange(len(segments)), segments]
+
+def fit_segmentation(customer_data, fingerprint=None):
+    """
+    fits the segmentation model and returns it as an artifact
+    parameters:
+        customer_data: the order lines, as returned by ORDER_LINES_QUERY
+        fingerprint: the data fingerprint stored with the artifact
+    """
+    df = prepare(customer_data)
+    enc = make_encoder(df.shape[0]).fit(df[COLS_TO_TRANSFORM])
+    processed_data = encode(enc, df, COLS_TO_TRANSFORM, COLS_TO_RETAIN)
+    fitted = fit_reduce_and_cluster(processed_data, PCA_PARAMS, KMEANS_PARAMS, UMAP_PARAMS, use_constrained=True)
+    df_plot, cluster_counts = label_clusters(fitted["labels"], fitted["umap_embeddings"])
+    # the reference the drift of new assignments is measured against, with the training rows assigned the same way
+    segments, distances = nearest_centroid(fitted["embeddings"], fitted["clusterer"].cluster_centers_)
+    n_clusters = len(fitted["clusterer"].cluster_centers_)
+    return {
+        "version": MODEL_VERSION,
+        "fingerprint": fingerprint,
+        "last_order_id": int(customer_data["OrderID"].max()),
+        "encoder": enc,
+        "pca": fitted["reducer"],
+        "clusterer": fitted["clusterer"],
+        "umap": fitted["umap"],
+        "labels": fitted["labels"],
+        "score": fitted["score"],
+        "df_plot": df_plot,
+        "cluster_counts": cluster_counts,
+        "mean_distances": np.bincount(segments, weights=distances, minlength=n_clusters) / np.maximum(np.bincount(segments, minlength=n_clusters), 1),
+        "proportions": np.bincount(segments, minlength=n_clusters) / len(segments),
+    }
+
+def load_segmentation(path=MODEL_PATH):
+    """
+    loads a persisted segmentation artifact, or returns None if there is none of the current version
+    """
+    if not os.path.exists(path):
+        return None
+    model = joblib.load(path)
+    return model if model.get("version") == MODEL_VERSION else None
+
+def save_segmentation(model, path=MODEL_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_or_fit_segmentation(fingerprint, load_data, path=MODEL_PATH):
+    """
+    returns the persisted segmentation if it was fitted on data with the given fingerprint, otherwise refits and persists it
+    parameters:
+        fingerprint: the fingerprint of the current data, see data_fingerprint
+        load_data: a callable returning the order lines, only called when a refit is needed
+        path: where the artifact is persisted
+    """
+    model = load_segmentation(path)
+    if model is not None and model["fingerprint"] == fingerprint:
+        return model
+    model = fit_segmentation(load_data(), fingerprint)
+    save_segmentation(model, path)
+    return model
+
+def read_new_order_lines(db_path, after, chunk_size=10000):
+    """
+    streams the order lines of the orders placed after an OrderID, chunk_size rows at a time
+    """
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        yield from pandas.read_sql(NEW_ORDER_LINES_QUERY, conn, params=(after,), chunksize=chunk_size)
+
+def unknown_categories(model, order_lines):
+    """
+    flags the rows with a category of the DRIFT_COLUMNS the encoder was not fitted on
+    """
+    unknown = np.zeros(len(order_lines), dtype=bool)
+    for col, categories in zip(COLS_TO_TRANSFORM, model["encoder"].categories_):
+        if col in DRIFT_COLUMNS:
+            unknown |= ~order_lines[col].isin(categories).to_numpy()
+    return unknown
+
+def assign_segments(model, order_lines, project=False):
+    """
+    assigns order lines to the fitted segments without refitting anything
+    the rows are encoded and reduced with the fitted encoder and PCA, then given the segment of the nearest centroid,
+    which ignores the cluster size constraints of the fit
+    returns a frame with the OrderID, ProductID, Segment, SegmentName, CentroidDistance and Unknown (whether the row
+    has an unseen category) of every complete row, plus its UMAP1 and UMAP2 coordinates when projecting
+    parameters:
+        model: a segmentation artifact, see fit_segmentation
+        order_lines: the order lines, as returned by ORDER_LINES_QUERY
+        project: whether to place the rows on the dashboard's 2d UMAP, which is much slower than the assignment
+    """
+    df = order_lines.dropna()
+    columns = ["OrderID", "ProductID", "Segment", "SegmentName", "CentroidDistance", "Unknown"] + (["UMAP1", "UMAP2"] if project else [])
+    if df.empty:
+        return pandas.DataFrame(columns=columns)
+    with warnings.catch_warnings():
+        # unseen categories are encoded as all zeros, they are reported by the Unknown column instead
+        warnings.filterwarnings("ignore", message="Found unknown categories")
+        X = encode(model["encoder"], df, COLS_TO_TRANSFORM, COLS_TO_RETAIN)
+    segments, distances = nearest_centroid(model["pca"].transform(X), model["clusterer"].cluster_centers_)
+    assigned = pandas.DataFrame({
+        "OrderID": df["OrderID"].to_numpy(),
+        "ProductID": df["ProductID"].to_numpy(),
+        "Segment": segments,
+        "SegmentName": np.asarray(LABEL_NAMES)[segments],
+        "CentroidDistance": distances,
+        "Unknown": unknown_categories(model, df),
+    })
+    if project:
+        assigned[["UMAP1", "UMAP2"]] = model["umap"].transform(X)
+    return assigned[columns]
+
+# below this many assigned rows the drift statistics are reported but too noisy to call for a refit
+MIN_DRIFT_ROWS = 200
+# floor of the mean training distance of a segment, a segment of identical rows has a mean distance of 0
+MIN_MEAN_DISTANCE = 1e-12
+
+class SegmentDrift:
+    """
+    accumulates drift statistics over batches of assignments
+    parameters:
+        model: the segmentation artifact the rows were assigned with
+    """
+    def __init__(self, model):
+        self.mean_distances = model["mean_distances"]
+        self.proportions = model["proportions"]
+        self.n_rows = 0
+        self.n_unknown = 0
+        self.distance_ratio_sum = 0.0
+        self.counts = np.zeros(len(self.proportions), dtype=int)
+
+    def update(self, assigned):
+        segments = assigned["Segment"].to_numpy(dtype=int)
+        self.n_rows += len(segments)
+        self.n_unknown += int(assigned["Unknown"].sum())
+        # distances relative to the mean distance of the training rows of the same segment
+        self.distance_ratio_sum += float(np.sum(assigned["CentroidDistance"].to_numpy(dtype=float) / np.maximum(self.mean_distances[segments], MIN_MEAN_DISTANCE)))
+        self.counts += np.bincount(segments, minlength=len(self.counts))
+
+    def report(self):
+        """
+        returns the drift statistics of the rows seen so far and whether they call for a refit
+        unknown_share: the share of rows with an unseen category
+        distance_ratio: the mean distance of the rows to their centroid, relative to the training rows of the same segment
+        proportion_shift: the total variation distance between the segment proportions and those of the training rows
+        """
+        if self.n_rows == 0:
+            return {"n_rows": 0, "unknown_share": 0.0, "distance_ratio": 1.0, "proportion_shift": 0.0, "refit": False}
+        stats = {
+            "n_rows": self.n_rows,
+            "unknown_share": self.n_unknown / self.n_rows,
+            "distance_ratio": self.distance_ratio_sum / self.n_rows,
+            "proportion_shift": 0.5 * float(np.abs(self.counts / self.n_rows - self.proportions).sum()),
+        }
+        stats["refit"] = self.n_rows >= MIN_DRIFT_ROWS and any(stats[key] > threshold for key, threshold in DRIFT_THRESHOLDS.items())
+        return stats
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fit the dashboard's customer segmentation and persist it, or assign new orders to it")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--model", default=MODEL_PATH, help="where the artifact is persisted")
+    parser.add_argument("--assign", action="store_true", help="assign the orders placed after the fit to the persisted segmentation instead of fitting")
+    parser.add_argument("--after", type=int, default=None, help="with --assign, the OrderID after which orders are assigned, defaults to the last order of the fit")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="with --assign, the number of order lines read and assigned at once")
+    parser.add_argument("--project", action="store_true", help="with --assign, also place the new rows on the 2d UMAP")
+    parser.add_argument("--output", default="./segment_assignments.csv", help="with --assign, where the assignments are written")
+    args = parser.parse_args()
+    if not args.assign:
+        model = load_or_fit_segmentation(data_fingerprint(args.db), lambda: read_order_lines(args.db), args.model)
+        print(f"Segmentation v{model['version']}: score {model['score']:.3f}, {model['cluster_counts']}")
+    else:
+        model = load_segmentation(args.model)
+        if model is None:
+            parser.error(f"no segmentation of version {MODEL_VERSION} at {args.model}, fit one first")
+        after = model["last_order_id"] if args.after is None else args.after
+        drift = SegmentDrift(model)
+        for i, chunk in enumerate(read_new_order_lines(args.db, after, args.chunk_size)):
+            assigned = assign_segments(model, chunk, project=args.project)
+            assigned.to_csv(args.output, mode="w" if i == 0 else "a", header=i == 0, index=False)
+            drift.update(assigned)
+        report = drift.report()
+        print(f"Assigned {report['n_rows']} order lines of orders after {after} to {args.output}")
+        print(f"Unknown categories {report['unknown_share']:.1%}, centroid distance ratio {report['distance_ratio']:.2f}, proportion shift {report['proportion_shift']:.3f}")
+        print("Drift calls for a refit" if report["refit"] else "No refit needed")
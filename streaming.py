@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Out-of-core segmentation of order histories that do not fit in memory.
+# The order lines are streamed out of SQLite chunk by chunk, several times over: a first pass counts the
+# category vocabulary, a second fits an incremental PCA, a third fits a mini-batch KMeans on the reduced
+# chunks, and a last pass assigns every order line to its segment. Only one chunk and the fitted models
+# are held in memory at a time, so memory follows the chunk size rather than the number of order lines.
+import os
+import sqlite3
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import IncrementalPCA
+from sklearn.cluster import MiniBatchKMeans
+from segmentation import ORDER_LINES_SELECT, ORDER_LINES_FILTER, COLS_TO_TRANSFORM, COLS_TO_RETAIN, PCA_PARAMS, KMEANS_PARAMS
+
+STREAMING_MODEL_PATH = "./cache/streaming_segmentation.joblib"
+# in primary key order, so SQLite can stream the join without sorting it first
+STREAM_QUERY = ORDER_LINES_SELECT + ORDER_LINES_FILTER + ' ORDER BY Orders.OrderID;'
+
+def read_chunks(db_path, chunk_size=10000):
+    """
+    streams the complete order lines, chunk_size rows at a time
+    """
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        for chunk in pd.read_sql(STREAM_QUERY, conn, chunksize=chunk_size):
+            chunk = chunk.dropna()
+            if not chunk.empty:
+                yield chunk
+
+class StreamingEncoder:
+    """
+    one-hot encodes chunks of order lines with a vocabulary counted over all of them, in the layout of utils.make_encoder:
+    the retained columns come first, then for every categorical column its sorted frequent categories followed by a
+    column shared by the categories rarer than 0.5% of the rows, which unseen categories also fall into, and the
+    first of these columns is dropped
+    parameters:
+        counts: the number of rows of every category, a dict of column to a Series indexed by category
+        n_rows: the number of rows counted
+    """
+    def __init__(self, counts, n_rows):
+        min_frequency = int(n_rows * 0.005)
+        self.n_rows = n_rows
+        self.frequent, self.infrequent_slot, self.offsets = [], [], []
+        offset = len(COLS_TO_RETAIN)
+        for col in COLS_TO_TRANSFORM:
+            col_counts = counts[col].sort_index()
+            is_frequent = (col_counts >= min_frequency).to_numpy()
+            frequent = col_counts.index[is_frequent]
+            infrequent = None if is_frequent.all() else len(frequent)
+            self.frequent.append(frequent)
+            self.infrequent_slot.append(infrequent)
+            self.offsets.append(offset)
+            offset += len(frequent) + (infrequent is not None) - 1
+        self.n_features = offset
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """
+        counts the vocabulary over a stream of chunks
+        """
+        counts = {col: pd.Series(dtype=np.int64) for col in COLS_TO_TRANSFORM}
+        n_rows = 0
+        for chunk in chunks:
+            n_rows += len(chunk)
+            for col in COLS_TO_TRANSFORM:
+                counts[col] = counts[col].add(chunk[col].value_counts(), fill_value=0)
+        return cls(counts, n_rows)
+
+    def transform(self, chunk):
+        """
+        returns the dense float64 feature matrix of a chunk
+        """
+        X = np.zeros((len(chunk), self.n_features))
+        X[:, :len(COLS_TO_RETAIN)] = chunk[COLS_TO_RETAIN].to_numpy(dtype=np.float64)
+        rows = np.arange(len(chunk))
+        for col, frequent, infrequent, offset in zip(COLS_TO_TRANSFORM, self.frequent, self.infrequent_slot, self.offsets):
+            slots = pd.Categorical(chunk[col], categories=frequent).codes.astype(np.int64)
+            slots[slots < 0] = -1 if infrequent is None else infrequent
+            # slot 0 is dropped, so slot s is written to column s - 1
+            keep = slots > 0
+            X[rows[keep], offset + slots[keep] - 1] = 1.0
+        return X
+
+def fit_streaming(db_path, chunk_size=10000, pca_params=PCA_PARAMS, kmeans_params=KMEANS_PARAMS):
+    """
+    fits the encoder vocabulary, an incremental PCA and a mini-batch KMeans in three streaming passes
+    mini-batch KMeans has no cluster size constraints, so the size_min of the dashboard's parameters is not applied
+    parameters:
+        db_path: the path of the SQLite database
+        chunk_size: the number of order lines held in memory at a time
+        pca_params: the parameters of the dashboard's PCA, of which the number of components and whitening are used
+        kmeans_params: the parameters of the dashboard's KMeans, of which the number of clusters, tolerance and seed are used
+    """
+    encoder = StreamingEncoder.from_chunks(read_chunks(db_path, chunk_size))
+
+    pca = IncrementalPCA(n_components=pca_params["n_components"], whiten=pca_params.get("whiten", False))
+    for chunk in read_chunks(db_path, chunk_size):
+        # every partial fit needs at least n_components rows, which only a short last chunk can lack
+        if len(chunk) >= pca.n_components:
+            pca.partial_fit(encoder.transform(chunk))
+
+    clusterer = MiniBatchKMeans(n_clusters=kmeans_params["n_clusters"], tol=kmeans_params.get("tol", 0.0), random_state=kmeans_params.get("random_state"), n_init=3)
+    for chunk in read_chunks(db_path, chunk_size):
+        if hasattr(clusterer, "cluster_centers_") or len(chunk) >= clusterer.n_clusters:
+            clusterer.partial_fit(pca.transform(encoder.transform(chunk)))
+    return {"encoder": encoder, "pca": pca, "clusterer": clusterer}
+
+def assign_streaming(model, db_path, chunk_size=10000):
+    """
+    assigns every order line to its segment in a streaming pass, yielding one frame of OrderID, ProductID and Segment per chunk
+    """
+    for chunk in read_chunks(db_path, chunk_size):
+        segments = model["clusterer"].predict(model["pca"].transform(model["encoder"].transform(chunk)))
+        yield pd.DataFrame({"OrderID": chunk["OrderID"].to_numpy(), "ProductID": chunk["ProductID"].to_numpy(), "Segment": segments})
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fit the customer segmentation out of core and assign every order line to a segment")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="the number of order lines held in memory at a time")
+    parser.add_argument("--model", default=STREAMING_MODEL_PATH, help="where the fitted models are persisted")
+    parser.add_argument("--output", default="./streaming_assignments.csv", help="where the assignments are written")
+    args = parser.parse_args()
+    model = fit_streaming(args.db, args.chunk_size)
+    os.makedirs(os.path.dirname(args.model) or ".", exist_ok=True)
+    joblib.dump(model, args.model)
+    counts = np.zeros(model["clusterer"].n_clusters, dtype=np.int64)
+    for i, assigned in enumerate(assign_streaming(model, args.db, args.chunk_size)):
+        assigned.to_csv(args.output, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        counts += np.bincount(assigned["Segment"], minlength=len(counts))
+    print(f"Assigned {model['encoder'].n_rows} order lines to {args.output}, segment sizes {counts.tolist()}")
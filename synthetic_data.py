@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# A synthetic scale-up of the Northwind database for benchmarking.
+# Customers are cloned factor times with their location, so the geographic mix is unchanged. Orders are
+# bootstrapped from the real ones with their order lines, given to a clone of the original customer and moved
+# by a few days, which keeps the seasonality, basket sizes, product mix, prices and discounts of the real data.
+import os
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# orders are moved by up to this many days either way, so that the scaled data has more distinct dates
+DATE_JITTER_DAYS = 15
+# the spread of the multiplicative noise applied to the order line quantities
+QUANTITY_NOISE = 0.3
+
+def _shift_dates(dates, days):
+    shifted = pd.to_datetime(dates, format="%Y-%m-%d") + pd.to_timedelta(days, unit="D")
+    return shifted.dt.strftime("%Y-%m-%d")
+
+def scale_database(src, dst, factor, seed=0, chunk_size=100000):
+    """
+    writes a copy of the database with factor times as many customers, orders and order lines
+    parameters:
+        src: the path of the Northwind SQLite database
+        dst: where the scaled database is written, it is overwritten
+        factor: the scale factor, an integer of at least 1
+        seed: the seed of the generator
+        chunk_size: the number of rows inserted at once
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    shutil.copyfile(src, dst)
+    with sqlite3.connect(dst) as conn:
+        customers = pd.read_sql("SELECT * FROM Customers", conn)
+        orders = pd.read_sql("SELECT * FROM Orders", conn)
+        details = pd.read_sql("SELECT * FROM [Order Details]", conn)
+        if factor <= 1:
+            return {"customers": len(customers), "orders": len(orders), "order_lines": len(details)}
+
+        # clone k of customer c gets the id c-k, k from 1 to factor - 1
+        clones = np.arange(1, factor)
+        new_customers = customers.loc[customers.index.repeat(factor - 1)].reset_index(drop=True)
+        copy = np.tile(clones, len(customers))
+        new_customers["CustomerID"] = new_customers["CustomerID"] + "-" + pd.Series(copy).astype(str)
+        new_customers["CompanyName"] = new_customers["CompanyName"] + " " + pd.Series(copy).astype(str)
+
+        # bootstrap the orders, each placed by the original customer of its template or by one of its clones
+        n_new = len(orders) * (factor - 1)
+        template = rng.integers(len(orders), size=n_new)
+        new_orders = orders.iloc[template].reset_index(drop=True)
+        new_orders["TemplateID"] = new_orders["OrderID"]
+        new_orders["OrderID"] = orders["OrderID"].max() + 1 + np.arange(n_new)
+        clone = rng.integers(factor, size=n_new)
+        new_orders["CustomerID"] = new_orders["CustomerID"].where(clone == 0, new_orders["CustomerID"] + "-" + pd.Series(clone).astype(str))
+        days = rng.integers(-DATE_JITTER_DAYS, DATE_JITTER_DAYS + 1, size=n_new)
+        for column in ["OrderDate", "RequiredDate", "ShippedDate"]:
+            new_orders[column] = _shift_dates(new_orders[column], days)
+        new_orders["Freight"] = (new_orders["Freight"] * rng.lognormal(0, QUANTITY_NOISE, size=n_new)).round(2)
+
+        new_details = new_orders[["OrderID", "TemplateID"]].merge(details.rename(columns={"OrderID": "TemplateID"}), on="TemplateID")
+        noise = rng.lognormal(0, QUANTITY_NOISE, size=len(new_details))
+        new_details["Quantity"] = np.maximum(1, np.round(new_details["Quantity"] * noise)).astype(int)
+
+        new_customers.to_sql("Customers", conn, if_exists="append", index=False, chunksize=chunk_size)
+        new_orders.drop(columns="TemplateID").to_sql("Orders", conn, if_exists="append", index=False, chunksize=chunk_size)
+        new_details.drop(columns="TemplateID").to_sql("Order Details", conn, if_exists="append", index=False, chunksize=chunk_size)
+    return {"customers": len(customers) * factor, "orders": len(orders) + n_new, "order_lines": len(details) + len(new_details)}
+
+def export_order_lines(db_path, path):
+    """
+    writes the order lines of a database to a CSV laid out like sales_data.csv
+    """
+    from segmentation import read_order_lines, prepare
+    order_lines = prepare(read_order_lines(db_path)).reset_index(drop=True)
+    order_lines.to_csv(path)
+    return len(order_lines)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a scaled-up synthetic copy of the Northwind database")
+    parser.add_argument("--db", default="./db/northwind.db", help="path of the Northwind SQLite database")
+    parser.add_argument("--factor", type=int, default=10, help="how many times more customers, orders and order lines to generate")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generator")
+    parser.add_argument("--output", default=None, help="where the scaled database is written, ./cache/northwind_x<factor>.db by default")
+    parser.add_argument("--csv", default=None, help="also write the scaled order lines to this CSV, laid out like sales_data.csv")
+    args = parser.parse_args()
+    output = args.output or f"./cache/northwind_x{args.factor}.db"
+    sizes = scale_database(args.db, output, args.factor, seed=args.seed)
+    print(f"Wrote {sizes['customers']} customers, {sizes['orders']} orders and {sizes['order_lines']} order lines to {output}")
+    if args.csv:
+        print(f"Wrote {export_order_lines(output, args.csv)} order lines to {args.csv}")
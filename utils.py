@@ -18,8 +18,9 @@ import streamlit as st
 import numpy as np
 import pandas as pd
 import umap.umap_ as umap
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
+from scipy import sparse
+from sklearn.decomposition import PCA, TruncatedSVD
+from scoring import score_clusters
 from k_means_constrained import KMeansConstrained
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import OneHotEncoder
@@ -34,53 +35,150 @@ def show_code(demo):
         sourcelines, _ = inspect.getsourcelines(demo)
         st.code(textwrap.dedent("".join(sourcelines[1:])))
 
-def clean_data(data, cols_to_transform, cols_to_retain):
+def make_encoder(n_rows, sparse_output=False):
+    """
+    builds the one-hot encoder used by clean_data
+    parameters:
+        n_rows: the number of rows the encoder is fitted on, categories rarer than 0.5% of them are grouped as infrequent
+        sparse_output: whether the encoder emits a float32 CSR matrix instead of a dense int matrix
+    """
+    return OneHotEncoder(
+        drop="first",
+        sparse_output=sparse_output,
+        min_frequency=int(n_rows * 0.005),
+        handle_unknown="infrequent_if_exist",
+        dtype=np.float32 if sparse_output else int,
+    )
+
+def clean_data(data, cols_to_transform, cols_to_retain, sparse_output=False):
     """
     preprocesses and transforms data
     parameters:
         data: the data to process
         cols_to_transform: columns in the data to transform with a one-hot encoder
         cols_to_retain: columns in the data to retain their orignal formats
+        sparse_output: whether to return a float32 CSR matrix instead of a dense array
     """
-    enc = OneHotEncoder(
-        drop="first",
-        sparse_output=False,
-        min_frequency=int(data.shape[0] * 0.005),
-        handle_unknown="infrequent_if_exist",
-        dtype=int,
-    )
-    transformed = enc.fit_transform(data[cols_to_transform])
+    enc = make_encoder(data.shape[0], sparse_output).fit(data[cols_to_transform])
+    return encode(enc, data, cols_to_transform, cols_to_retain)
+
+def encode(enc, data, cols_to_transform, cols_to_retain):
+    """
+    transforms data with an already fitted encoder into the feature matrix of clean_data
+    parameters:
+        enc: an encoder from make_encoder, fitted on the cols_to_transform of some data
+        data: the data to transform
+        cols_to_transform: columns in the data to transform with the encoder
+        cols_to_retain: columns in the data to retain their orignal formats
+    """
+    transformed = enc.transform(data[cols_to_transform])
+    if enc.sparse_output:
+        retained = sparse.csr_matrix(data[cols_to_retain].to_numpy(dtype=np.float32))
+        return sparse.hstack([retained, transformed], format="csr", dtype=np.float32)
     processed_data = np.concatenate([data[cols_to_retain], transformed], axis=1)
 
     return processed_data
 
-def reduce_and_cluster(data, pca_params, kmeans_params, umap_params, use_constrained=False):
+def feature_footprint(processed_data, dense_dtype=np.float64):
     """
-    performs dimensional reduction and clustering given a set of parameters and generate figures for the resulting clusters with 2d umap
+    reports the memory footprint in bytes of a feature matrix and of its dense equivalent
+    parameters:
+        processed_data: the output of clean_data, dense or sparse
+        dense_dtype: the dtype of the dense equivalent, float64 as in the dense runs of framework.py
+    """
+    n_cells = processed_data.shape[0] * processed_data.shape[1]
+    if sparse.issparse(processed_data):
+        nbytes = processed_data.data.nbytes + processed_data.indices.nbytes + processed_data.indptr.nbytes
+    else:
+        nbytes = processed_data.nbytes
+    return {
+        "shape": processed_data.shape,
+        "sparse": sparse.issparse(processed_data),
+        "nbytes": nbytes,
+        "dense_nbytes": n_cells * np.dtype(dense_dtype).itemsize,
+        "density": (processed_data.nnz if sparse.issparse(processed_data) else np.count_nonzero(processed_data)) / max(n_cells, 1),
+    }
+
+def make_sparse_reducer(pca_params):
+    """
+    builds a reducer that accepts CSR input for a set of PCA parameters
+    PCA only runs on sparse data with the arpack and covariance_eigh solvers, so "full" maps to the exact covariance_eigh solver
+    and "randomized" maps to a randomized TruncatedSVD, which skips the mean centering PCA would need to densify the matrix
+    and ignores whiten and tol, framework.suggest_pipeline does not sample them for it
     parameters:
-        data: the dataset
         pca_params: the set of parameters for PCA
-        kmeans_params: the set of parameters for KMeans
-        umap_params: the set of parameters for 2d UMAP
-        use_constrained: whether or not to use KMeans constrained
     """
-    reducer = PCA(**pca_params)
+    params = dict(pca_params)
+    solver = params.get("svd_solver", "auto")
+    if solver == "randomized":
+        # unnormalized power iterations overflow float32 on the unscaled price columns
+        normalizer = params.get("power_iteration_normalizer", "auto")
+        return TruncatedSVD(
+            n_components=params.get("n_components", 2),
+            algorithm="randomized",
+            n_oversamples=params.get("n_oversamples", 10),
+            power_iteration_normalizer="LU" if normalizer == "none" else normalizer,
+            random_state=params.get("random_state"),
+        )
+    if solver == "full":
+        params["svd_solver"] = "covariance_eigh"
+    return PCA(**params)
+
+LABEL_NAMES = ["Dairy Dominators", "Generous Spenders", "Frequent Thrifters", "Selective Shoppers", "Bulk Bargain Shoppers", "Steady Spenders", "The Internationals"]
+
+def fit_reduce_and_cluster(data, pca_params, kmeans_params, umap_params, use_constrained=False, metric="silhouette"):
+    """
+    fits the dimensional reduction, clustering and 2d umap of reduce_and_cluster and returns the fitted models with their outputs
+    parameters: see reduce_and_cluster
+    """
+    reducer = make_sparse_reducer(pca_params) if sparse.issparse(data) else PCA(**pca_params)
     embeddings = reducer.fit_transform(data)
     
     clusterer = KMeansConstrained(**kmeans_params) if use_constrained else KMeans(**kmeans_params)
     labels = clusterer.fit_predict(embeddings)
-    score = silhouette_score(embeddings, labels)
+    score, _ = score_clusters(embeddings, labels, metric=metric, random_state=99)
     
     umap_2d = umap.UMAP(**umap_params)
     umap_embeddings = umap_2d.fit_transform(data)
-    
+
+    return {
+        "reducer": reducer,
+        "clusterer": clusterer,
+        "umap": umap_2d,
+        "embeddings": embeddings,
+        "labels": labels,
+        "umap_embeddings": umap_embeddings,
+        "score": score,
+    }
+
+def label_clusters(labels, umap_embeddings):
+    """
+    names the clusters and builds the frame plotted by the dashboard
+    parameters:
+        labels: the cluster index of every row
+        umap_embeddings: the 2d umap projection of every row
+    """
     df_plot = pd.DataFrame(umap_embeddings, columns=['UMAP1', 'UMAP2'])
 
-    label_names = ["Dairy Dominators", "Generous Spenders", "Frequent Thrifters", "Selective Shoppers", "Bulk Bargain Shoppers", "Steady Spenders", "The Internationals"]
-    labels_ = [label_names[l] for l in labels]
+    labels_ = [LABEL_NAMES[l] for l in labels]
     cluster_counts = dict(zip(*np.unique(labels_, return_counts=True)))
     
     df_plot['Cluster'] = labels_
     
-    return score, df_plot, cluster_counts
+    return df_plot, cluster_counts
 
+def reduce_and_cluster(data, pca_params, kmeans_params, umap_params, use_constrained=False, metric="silhouette"):
+    """
+    performs dimensional reduction and clustering given a set of parameters and generate figures for the resulting clusters with 2d umap
+    parameters:
+        data: the dataset, a dense array or a CSR matrix from clean_data(..., sparse_output=True)
+        pca_params: the set of parameters for PCA
+        kmeans_params: the set of parameters for KMeans
+        umap_params: the set of parameters for 2d UMAP
+        use_constrained: whether or not to use KMeans constrained
+        metric: the cluster quality score, one of scoring.SCORERS
+    """
+    fitted = fit_reduce_and_cluster(data, pca_params, kmeans_params, umap_params, use_constrained, metric)
+    df_plot, cluster_counts = label_clusters(fitted["labels"], fitted["umap_embeddings"])
+    
+    return fitted["score"], df_plot, cluster_counts
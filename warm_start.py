@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Warm starts of the model search from the trial histories of earlier runs, and a persistent memo of scores.
+# A history (a trials dataframe such as session.csv) is replayed through the define-by-run search space with
+# optuna.trial.FixedTrial, which recovers the distribution of every parameter on the path the configuration takes
+# and drops the configurations the current space no longer contains. Its best configurations can then be enqueued,
+# so they are evaluated again on the current data, or its completed trials imported with their scores, which is
+# only meaningful when they were scored on the same data with the same metric.
+# The memo maps configurations, with floats rounded to a few significant digits, to the score they got on a given
+# data and metric, so that a configuration the sampler proposes again is answered without fitting anything.
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+import optuna
+import pandas as pd
+
+MEMO_PATH = "./cache/trial_memo.sqlite"
+# configurations whose floats agree to this many significant digits share a score
+MEMO_DIGITS = 3
+# the number of best configurations of a history enqueued by default
+DEFAULT_TOP = 20
+
+MEMO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS TrialMemo (
+    Key TEXT PRIMARY KEY,
+    Context TEXT NOT NULL,
+    Params TEXT NOT NULL,
+    Value REAL NOT NULL,
+    Created TEXT NOT NULL DEFAULT (datetime('now'))
+)
+"""
+
+def canonical_params(params, digits=MEMO_DIGITS):
+    """
+    returns the parameters as a JSON string with sorted names and floats rounded to digits significant digits
+    """
+    def canonical(value):
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        if isinstance(value, (float, np.floating)):
+            value = float(value)
+            return value if not np.isfinite(value) or value == 0 else float(f"{value:.{digits}g}")
+        return value
+    return json.dumps({name: canonical(value) for name, value in sorted(params.items())})
+
+class TrialMemo:
+    """
+    a persistent map of configurations to their score, shared by the workers and runs of a study
+    a score is only reused within its context, the data, metric and scoring settings it was computed with, and the
+    first score stored for a configuration is kept, so stochastic configurations are answered with their first score
+    parameters:
+        path: the SQLite file holding the memo
+        digits: the significant digits floats are rounded to, configurations equal after rounding share a score
+    """
+    def __init__(self, path=MEMO_PATH, digits=MEMO_DIGITS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.digits = digits
+        self.hits = 0
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(MEMO_SCHEMA)
+
+    def key(self, params, context):
+        return hashlib.sha256(f"{context}\n{canonical_params(params, self.digits)}".encode()).hexdigest()
+
+    def get(self, params, context=""):
+        """
+        returns the score of a configuration in a context, or None if it was never scored
+        """
+        row = self.conn.execute("SELECT Value FROM TrialMemo WHERE Key = ?", (self.key(params, context),)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, params, value, context=""):
+        self.conn.execute("INSERT OR IGNORE INTO TrialMemo (Key, Context, Params, Value) VALUES (?, ?, ?, ?)",
+                          (self.key(params, context), context, canonical_params(params, self.digits), float(value)))
+
+    def close(self):
+        self.conn.close()
+
+def read_history(path):
+    """
+    reads the completed trials of a trials dataframe
+    returns one dict per trial with its params (the non-empty params_ columns), value, metric and level, trials written
+    before the metric and level were recorded count as silhouette scores of order lines
+    """
+    # categories such as "none" must not be read as missing values
+    session = pd.read_csv(path, keep_default_na=False, na_values=[""])
+    if "state" in session:
+        session = session[session["state"] == "COMPLETE"]
+    session = session[session["value"].notna()]
+    param_columns = [column for column in session if column.startswith("params_")]
+    history = []
+    for record in session.to_dict("records"):
+        params = {column[len("params_"):]: record[column] for column in param_columns if not pd.isna(record[column])}
+        # booleans of columns with missing values are read back as strings
+        params = {name: {"True": True, "False": False}.get(value, value) if isinstance(value, str) else value for name, value in params.items()}
+        history.append({
+            "params": params,
+            "value": float(record["value"]),
+            "metric": record.get("user_attrs_metric") if not pd.isna(record.get("user_attrs_metric", np.nan)) else "silhouette",
+            "level": record.get("user_attrs_level") if not pd.isna(record.get("user_attrs_level", np.nan)) else "order_lines",
+        })
+    return history
+
+def _typed(value, distribution):
+    # the CSV reads every numeric parameter back as a float
+    if isinstance(distribution, optuna.distributions.IntDistribution):
+        return int(round(value))
+    if isinstance(distribution, optuna.distributions.FloatDistribution):
+        return float(value)
+    for choice in distribution.choices:
+        if choice == value or str(choice) == str(value):
+            return choice
+    return value
+
+def replay(params, suggest):
+    """
+    replays a configuration through the search space
+    returns its parameters typed as the space expects and their distributions, or None if the space does not contain it
+    parameters:
+        params: the parameters of the configuration, extra parameters are dropped
+        suggest: a function sampling a trial's configuration, such as framework.suggest_pipeline without the data
+    """
+    trial = optuna.trial.FixedTrial(params)
+    try:
+        suggest(trial)
+        distributions = trial.distributions
+        typed = {name: _typed(params[name], distribution) for name, distribution in distributions.items()}
+        # validates every value against its distribution
+        optuna.trial.create_trial(params=typed, distributions=distributions, value=0.0)
+    except (ValueError, TypeError, KeyError):
+        return None
+    return typed, distributions
+
+def seed_study(study, history, suggest, mode="enqueue", top=DEFAULT_TOP, metric="silhouette", level="order_lines", source=None):
+    """
+    seeds a study with the configurations of a history that it does not hold yet
+    returns the number of trials enqueued or imported
+    parameters:
+        study: the study to seed
+        history: the trials of earlier runs, see read_history
+        suggest: a function sampling a trial's configuration, see replay
+        mode: enqueue to evaluate the best configurations again, import to add the completed trials with their scores,
+            which keeps only those scored with the same metric on the same level
+        top: the number of best distinct configurations used, or None for all of them
+        metric: the metric of the study
+        level: what a row of the study's data is, customers or order_lines
+        source: recorded as the warm_start user attribute of the seeded trials
+    """
+    if mode == "import":
+        history = [h for h in history if h["metric"] == metric and h["level"] == level]
+    seen = {canonical_params(t.params) for t in study.get_trials(deepcopy=False)}
+    seeded = []
+    for h in sorted(history, key=lambda h: h["value"], reverse=True):
+        if top is not None and len(seeded) >= top:
+            break
+        replayed = replay(h["params"], suggest)
+        if replayed is None:
+            continue
+        params, distributions = replayed
+        key = canonical_params(params)
+        if key in seen:
+            continue
+        seen.add(key)
+        seeded.append((params, distributions, h))
+
+    user_attrs = {"warm_start": source or "history"}
+    if mode == "import":
+        study.add_trials([optuna.trial.create_trial(params=params, distributions=distributions, value=h["value"],
+                                                    user_attrs=dict(user_attrs, metric=h["metric"], level=h["level"]))
+                          for params, distributions, h in seeded])
+    else:
+        for params, _, _ in seeded:
+            study.enqueue_trial(params, user_attrs=user_attrs)
+    return len(seeded)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Report the duplicate configurations of a trial history and the contents of the score memo")
+    parser.add_argument("--input", default="./session.csv", help="a trials dataframe written by framework.py")
+    parser.add_argument("--memo", default=MEMO_PATH, help="the score memo")
+    parser.add_argument("--digits", type=int, default=MEMO_DIGITS, help="significant digits floats are compared to")
+    args = parser.parse_args()
+    history = read_history(args.input)
+    keys = pd.Series([canonical_params(h["params"], args.digits) for h in history])
+    print(f"{len(history)} completed trials in {args.input}, {keys.nunique()} distinct configurations to {args.digits} significant digits, "
+          f"{len(history) - keys.nunique()} trials spent on repeats")
+    if os.path.exists(args.memo):
+        memo = TrialMemo(args.memo)
+        for context, count in memo.conn.execute("SELECT Context, COUNT(*) FROM TrialMemo GROUP BY Context"):
+            print(f"memo {context}: {count} configurations")
+        memo.close()